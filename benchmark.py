@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from compress import SIDECAR_SUFFIXES
+from patcher import DOWNLOAD_CHUNK_SIZE, FSYNC_POLICIES, WRITE_BUFFER_SIZE
+from mock_server import generate_tree, mutate_tree, start_server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_phase(name, install_path, home, port, workers, verify=False, delta_patching=True):
+    """Run one headless patch in a child process and return its measurements."""
+    command = [
+        sys.executable, os.path.join(HERE, "headless.py"), "--install-path", install_path,
+        "--server", f"127.0.0.1:{port}", "--workers", str(workers), "--no-discovery",
+    ]
+    if verify:
+        command.append("--verify")
+    if not delta_patching:
+        command.append("--no-delta")
+    # Each benchmark gets its own ~/.epic_shard_launcher so the user's state and caches stay untouched
+    env = dict(os.environ, HOME=home, USERPROFILE=home)
+
+    started = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env, text=True)
+    first_byte = None
+    files_completed = 0
+    files_hashed = 0
+    bytes_downloaded = 0
+    finished = {}
+    for line in process.stdout:
+        event = json.loads(line)
+        if event["event"] == "progress":
+            if first_byte is None:
+                first_byte = time.monotonic()
+            bytes_downloaded = event["bytes"]
+        elif event["event"] == "hashing":
+            files_hashed += 1
+        elif event["event"] == "files":
+            files_completed = event["completed"]
+        elif event["event"] in ("finished", "error"):
+            finished = event
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - started
+
+    # The progress events count decompressed bytes; the trace has what actually crossed the network
+    wire_bytes = None
+    if finished.get("trace"):
+        try:
+            with open(finished["trace"]) as f:
+                wire_bytes = json.load(f)["otherData"]["counters"].get("bytes_downloaded", 0)
+        except (OSError, ValueError, KeyError):
+            pass
+    # A verify run downloads nothing; its work is the files it hashed
+    files = files_completed or files_hashed
+
+    return {
+        "phase": name,
+        "exit_code": os.waitstatus_to_exitcode(status),
+        "success": finished.get("success", False),
+        "failed_files": len(finished.get("failed_files", [])),
+        "elapsed": round(elapsed, 3),
+        "ttfb": round(first_byte - started, 3) if first_byte else None,
+        "files": files,
+        "files_per_second": round(files / elapsed, 1) if elapsed else 0,
+        "bytes": bytes_downloaded,
+        "wire_bytes": wire_bytes,
+        "mb_per_second": round(bytes_downloaded / (1024 * 1024) / elapsed, 2) if elapsed else 0,
+        "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),  # ru_maxrss is in KiB on Linux
+    }
+
+
+def write_settings(args):
+    """Return the config.json keys of the download write path being measured."""
+    return {
+        "download_chunk_size": args.chunk_size, "write_buffer_size": args.write_buffer,
+        "preallocate": not args.no_preallocate, "download_buffer_pool": args.buffer_pool, "fsync": args.fsync,
+    }
+
+
+def run_benchmark(args):
+    """Generate the tree, serve it and run the download, no-op and verify pipelines."""
+    workdir = tempfile.mkdtemp(prefix="epic_bench_")
+    try:
+        root = os.path.join(workdir, "server")
+        home = os.path.join(workdir, "home")
+        install_path = os.path.join(workdir, "install")
+        for path in (root, home, install_path):
+            os.makedirs(path)
+        # The write path settings reach the headless launcher through its config.json
+        os.makedirs(os.path.join(home, ".epic_shard_launcher"))
+        with open(os.path.join(home, ".epic_shard_launcher", "config.json"), "w") as f:
+            json.dump(write_settings(args), f)
+
+        print(f"Gerando {args.files} arquivos ({args.size_dist})...", file=sys.stderr)
+        total_bytes = generate_tree(root, args.files, args.size_dist, args.seed, not args.no_delta,
+                                    args.redundancy, args.compress)
+        server = start_server(root, 0, args.latency, args.bandwidth * 1024 * 1024)
+
+        results = []
+        # download: empty install; noop: nothing changed; update: part of the files changed on the server;
+        # verify: full rehash of the install
+        for name, verify in (("download", False), ("noop", False), ("update", False), ("verify", True)):
+            if name in args.phases:
+                if name == "update":
+                    changed = mutate_tree(root, args.mutate, args.seed + 1)
+                    print(f"{changed} arquivos alterados no servidor", file=sys.stderr)
+                print(f"Executando {name}...", file=sys.stderr)
+                results.append(run_phase(
+                    name, install_path, home, server.server_port, args.workers, verify, not args.no_delta
+                ))
+        server.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "settings": {
+            "files": args.files, "size_dist": args.size_dist, "seed": args.seed, "total_bytes": total_bytes,
+            "latency": args.latency, "bandwidth": args.bandwidth, "workers": args.workers,
+            "mutate": args.mutate, "delta": not args.no_delta,
+            "redundancy": args.redundancy, "compress": args.compress, **write_settings(args),
+        },
+        "results": results,
+    }
+
+
+def print_report(report, baseline=None):
+    """Print a table of the results, with the change against a baseline report when given."""
+    baseline_results = {r["phase"]: r for r in baseline["results"]} if baseline else {}
+    print(f"{'fase':<10}{'tempo (s)':>11}{'TTFB (s)':>10}{'arquivos/s':>12}{'MB/s':>9}{'rede (MB)':>11}{'RSS (MB)':>10}")
+    for result in report["results"]:
+        ttfb = f"{result['ttfb']:.3f}" if result["ttfb"] is not None else "-"
+        wire = f"{result['wire_bytes'] / (1024 * 1024):.2f}" if result.get("wire_bytes") is not None else "-"
+        line = (f"{result['phase']:<10}{result['elapsed']:>11.3f}{ttfb:>10}{result['files_per_second']:>12.1f}"
+                f"{result['mb_per_second']:>9.2f}{wire:>11}{result['peak_rss_mb']:>10.1f}")
+        previous = baseline_results.get(result["phase"])
+        if previous and previous["elapsed"]:
+            line += f"   {(result['elapsed'] / previous['elapsed'] - 1) * 100:+.1f}% tempo"
+        if not result["success"] or result["failed_files"]:
+            line += f"   FALHOU (código {result['exit_code']}, {result['failed_files']} arquivos)"
+        print(line)
+
+
+def main(argv=None):
+    """Run the patch benchmarks against a local mock server and save the results as JSON."""
+    parser = argparse.ArgumentParser(description="Benchmark do patcher contra um servidor local.")
+    parser.add_argument("--files", type=int, default=1000, help="quantidade de arquivos gerados")
+    parser.add_argument("--size-dist", default="lognormal:20000:1.5",
+                        help="fixed:SIZE, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA ou uo")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="atraso por requisição, em segundos")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="limite de banda total, em MB/s (0 = sem limite)")
+    parser.add_argument("--workers", type=int, default=4, help="arquivos baixados ao mesmo tempo")
+    parser.add_argument("--mutate", type=float, default=0.1, help="fração dos arquivos alterados antes do update")
+    parser.add_argument("--no-delta", action="store_true", help="desliga o patch por blocos")
+    parser.add_argument("--redundancy", type=float, default=0.0, help="fração de zeros em cada arquivo (0 a 1)")
+    parser.add_argument("--compress", choices=sorted(SIDECAR_SUFFIXES), help="publica cópias comprimidas dos arquivos")
+    parser.add_argument("--chunk-size", type=int, default=DOWNLOAD_CHUNK_SIZE // 1024,
+                        help="bytes lidos da conexão por vez, em KB")
+    parser.add_argument("--write-buffer", type=int, default=WRITE_BUFFER_SIZE // 1024,
+                        help="buffer de escrita dos arquivos baixados, em KB (0 = o mínimo)")
+    parser.add_argument("--no-preallocate", action="store_true", help="não reserva o espaço dos arquivos antes de baixar")
+    parser.add_argument("--buffer-pool", action="store_true", help="lê a conexão em buffers reaproveitados (readinto)")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="commit", help="quando os arquivos são sincronizados no disco")
+    parser.add_argument("--phases", nargs="+", default=["download", "noop", "update", "verify"],
+                        choices=["download", "noop", "update", "verify"])
+    parser.add_argument("--output", help="arquivo JSON com os resultados (padrão: benchmark-<data>.json)")
+    parser.add_argument("--compare", help="JSON de uma execução anterior para comparar")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args)
+    output = args.output or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"Resultados salvos em {output}", file=sys.stderr)
+    return 0 if all(r["success"] and not r["failed_files"] for r in report["results"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import os
+import sys
+import zlib
+import argparse
+
+# Pre-compressed copies published next to the files: /<path>.zst or /<path>.gz. Hashes flags them with an
+# extra column holding the format (the third, unless it already has more), which older launchers ignore.
+SIDECAR_SUFFIXES = {"zst": ".zst", "gz": ".gz"}
+COMPRESS_MIN_SIZE = 64 * 1024  # Smaller files are left to the transfer-level compression of the server
+COMPRESS_MIN_SAVING = 0.1  # Sidecars saving less than this fraction of the file are not published
+ZSTD_LEVEL = 19  # Compressed once on the server, decompressed by every launcher: slow levels pay off
+GZIP_LEVEL = 9
+
+
+def zstandard_module():
+    """Return the optional zstandard module, or None if it isn't installed."""
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def available_formats():
+    """Sidecar formats this launcher can decompress, preferred first."""
+    return ("zst", "gz") if zstandard_module() else ("gz",)
+
+
+def decompressor(compression):
+    """Return a streaming decompressor with decompress(data) and eof for a sidecar format."""
+    if compression == "gz":
+        return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    if compression == "zst":
+        zstandard = zstandard_module()
+        if zstandard is None:
+            raise ValueError("O módulo zstandard não está instalado")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Formato de compressão desconhecido: {compression}")
+
+
+def compressor(compression):
+    """Return a streaming compressor with compress(data) and flush() for a sidecar format."""
+    if compression == "gz":
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == "zst":
+        zstandard = zstandard_module()
+        if zstandard is None:
+            raise ValueError("O módulo zstandard não está instalado")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Formato de compressão desconhecido: {compression}")
+
+
+def write_sidecar(file_path, compression="zst", buffer_size=1024 * 1024):
+    """Write the compressed sidecar of a file. Returns the sidecar's path."""
+    sidecar_path = file_path + SIDECAR_SUFFIXES[compression]
+    stream = compressor(compression)
+    with open(file_path, "rb") as source, open(sidecar_path, "wb") as out:
+        for chunk in iter(lambda: source.read(buffer_size), b""):
+            out.write(stream.compress(chunk))
+        out.write(stream.flush())
+    return sidecar_path
+
+
+def compress_tree(root, compression="zst", min_size=COMPRESS_MIN_SIZE, min_saving=COMPRESS_MIN_SAVING):
+    """Write sidecars for the files listed in root/Hashes and flag them with a format column.
+
+    The format replaces an earlier one or is appended; any other extra columns are kept as they are.
+
+    Files below min_size, or whose sidecar saves less than min_saving, are left uncompressed.
+    Returns (files compressed, bytes saved).
+    """
+    hashes_path = os.path.join(root, "Hashes")
+    with open(hashes_path, "r", encoding="utf-8-sig") as f:
+        lines = f.read().splitlines()
+
+    compressed = 0
+    saved = 0
+    for i, line in enumerate(lines):
+        parts = line.split("\t")
+        if len(parts) < 2:
+            continue
+        # Hashes is keyed by Manifest path; "+" files are stored on the server without the flag
+        dir_path, file_name = os.path.split(parts[0].strip())
+        local_path = os.path.join(root, dir_path.lstrip("/"), file_name.lstrip("+"))
+        for suffix in SIDECAR_SUFFIXES.values():
+            if os.path.exists(local_path + suffix):
+                os.remove(local_path + suffix)
+        parts = parts[:2] + [part for part in parts[2:] if part.strip() not in SIDECAR_SUFFIXES]
+
+        size = os.path.getsize(local_path) if os.path.isfile(local_path) else 0
+        if size >= min_size:
+            sidecar_path = write_sidecar(local_path, compression)
+            sidecar_size = os.path.getsize(sidecar_path)
+            if sidecar_size <= size * (1 - min_saving):
+                parts.append(compression)
+                compressed += 1
+                saved += size - sidecar_size
+            else:
+                os.remove(sidecar_path)
+        lines[i] = "\t".join(parts)
+
+    with open(hashes_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return compressed, saved
+
+
+def main(argv=None):
+    """Publish compressed sidecars for a patch server directory."""
+    parser = argparse.ArgumentParser(description="Gera cópias comprimidas dos arquivos do servidor de patch.")
+    parser.add_argument("--root", required=True, help="diretório servido (Manifest, Hashes e arquivos)")
+    parser.add_argument("--format", choices=sorted(SIDECAR_SUFFIXES), default="zst")
+    parser.add_argument("--min-size", type=int, default=COMPRESS_MIN_SIZE, help="tamanho mínimo, em bytes")
+    args = parser.parse_args(argv)
+
+    compressed, saved = compress_tree(args.root, args.format, args.min_size)
+    print(f"{compressed} arquivos comprimidos, {saved / (1024 * 1024):.1f} MB a menos para baixar")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
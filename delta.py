@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import hashlib
+from itertools import accumulate
+
+BLOCK_INDEX_SUFFIX = ".blocks"  # Sidecar published next to each large file: /<path>.blocks
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DELTA_MIN_SIZE = 4 * 1024 * 1024  # Smaller files are always downloaded whole
+ROLLING_SCAN_LIMIT = 8 * 1024 * 1024  # Bytes of unmatched local data searched byte by byte for shifted blocks
+
+
+def weak_checksum(data):
+    """rsync's weak checksum of a block: 16-bit byte sum and 16-bit position-weighted sum."""
+    a = sum(data) & 0xFFFF
+    b = sum(accumulate(data)) & 0xFFFF  # Equivalent to sum((len - i) * x_i)
+    return a | (b << 16)
+
+
+def build_block_index(file_path, block_size=DEFAULT_BLOCK_SIZE):
+    """Return the block index of a file: its size, MD5 and [weak, md5] of every block."""
+    hash_md5 = hashlib.md5()
+    blocks = []
+    with open(file_path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            hash_md5.update(block)
+            blocks.append([weak_checksum(block), hashlib.md5(block).hexdigest()])
+    return {
+        "size": os.path.getsize(file_path),
+        "block_size": block_size,
+        "md5": hash_md5.hexdigest(),
+        "blocks": blocks,
+    }
+
+
+def write_block_index(file_path, block_size=DEFAULT_BLOCK_SIZE):
+    """Write the block index sidecar of a file. Returns the sidecar's path."""
+    index_path = file_path + BLOCK_INDEX_SUFFIX
+    with open(index_path, "w") as f:
+        json.dump(build_block_index(file_path, block_size), f)
+    return index_path
+
+
+def match_blocks(local_path, index, rolling_limit=ROLLING_SCAN_LIMIT, stop=None):
+    """Find the remote blocks already present in a local file.
+
+    Returns a list with, for every block in the index, the local offset holding the same bytes or None.
+    Block-aligned positions are checked first; the unmatched parts of the file are then searched with
+    the rolling checksum, up to rolling_limit bytes, to find blocks that shifted. If stop() becomes true
+    the search ends early with the blocks found so far.
+    """
+    block_size = index["block_size"]
+    blocks = index["blocks"]
+    sources = [None] * len(blocks)
+    by_strong = {}  # md5 -> remote block numbers
+    by_weak = {}  # weak -> remote block numbers
+    last_size = index["size"] - (len(blocks) - 1) * block_size if blocks else 0
+    for number, (weak, strong) in enumerate(blocks):
+        by_strong.setdefault(strong, []).append(number)
+        # The rolling window is always block_size long, so a short last block can't be found by it
+        if number < len(blocks) - 1 or last_size == block_size:
+            by_weak.setdefault(weak, []).append(number)
+
+    def claim(numbers, offset):
+        matched = False
+        for number in numbers:
+            if sources[number] is None:
+                sources[number] = offset
+                matched = True
+                # A claimed block is no longer a rolling candidate: left in, a run of repeated bytes (zeros)
+                # matching its weak checksum would cost an MD5 of the window at every position
+                weak = blocks[number][0]
+                if number in by_weak.get(weak, ()):
+                    by_weak[weak].remove(number)
+                    if not by_weak[weak]:
+                        del by_weak[weak]
+        return matched
+
+    local_size = os.path.getsize(local_path)
+    unmatched = []  # (start, end) local ranges with no aligned match
+    with open(local_path, "rb") as f:
+        for offset in range(0, local_size, block_size):
+            if stop is not None and stop():
+                return sources
+            block = f.read(block_size)
+            numbers = by_strong.get(hashlib.md5(block).hexdigest())
+            if numbers:
+                # Also when all of them are claimed already: the bytes are known, there's nothing to search
+                claim(numbers, offset)
+                continue
+            if unmatched and unmatched[-1][1] == offset:
+                unmatched[-1] = (unmatched[-1][0], offset + len(block))
+            else:
+                unmatched.append((offset, offset + len(block)))
+
+        # The last remote block is usually short; look for it at the end of the local file too
+        if blocks and sources[-1] is None and 0 < last_size < block_size and local_size >= last_size:
+            f.seek(local_size - last_size)
+            if hashlib.md5(f.read(last_size)).hexdigest() == blocks[-1][1]:
+                sources[-1] = local_size - last_size
+
+        budget = rolling_limit
+        for start, end in unmatched:
+            if budget <= 0 or None not in sources:
+                break
+            # Extend the window so blocks that straddle the range boundary can be found
+            f.seek(start)
+            data = f.read(min(end - start, budget) + block_size - 1)
+            budget -= end - start
+            rolling_search(data, start, block_size, blocks, by_weak, claim, stop)
+
+    return sources
+
+
+def rolling_search(data, base_offset, block_size, blocks, by_weak, claim, stop=None):
+    """Slide the weak checksum over data one byte at a time, claiming blocks whose MD5 also matches."""
+    if len(data) < block_size:
+        return
+    a = sum(data[:block_size]) & 0xFFFF
+    b = sum(accumulate(data[:block_size])) & 0xFFFF
+    position = 0
+    last_position = len(data) - block_size
+    while True:
+        numbers = by_weak.get(a | (b << 16))
+        if numbers:
+            window = data[position:position + block_size]
+            strong = hashlib.md5(window).hexdigest()
+            matching = [number for number in numbers if blocks[number][1] == strong]
+            if matching and claim(matching, base_offset + position):
+                # Skip past the matched block and restart the checksum there
+                position += block_size
+                if position > last_position:
+                    return
+                window = data[position:position + block_size]
+                a = sum(window) & 0xFFFF
+                b = sum(accumulate(window)) & 0xFFFF
+                continue
+
+        if position >= last_position:
+            return
+        if stop is not None and position % block_size == 0 and stop():
+            return
+        out_byte = data[position]
+        in_byte = data[position + block_size]
+        a = (a - out_byte + in_byte) & 0xFFFF
+        b = (b - block_size * out_byte + a) & 0xFFFF
+        position += 1
+
+
+def plan_ranges(index, sources):
+    """Merge the block sources into runs: [(start, end, local_offset or None)], end exclusive.
+
+    Runs with a local offset are copied from the local file, the others are fetched with a Range request.
+    """
+    block_size = index["block_size"]
+    size = index["size"]
+    runs = []
+    for number, local_offset in enumerate(sources):
+        start = number * block_size
+        end = min(start + block_size, size)
+        if runs:
+            previous_start, previous_end, previous_offset = runs[-1]
+            if local_offset is None and previous_offset is None:
+                runs[-1] = (previous_start, end, None)
+                continue
+            if (local_offset is not None and previous_offset is not None
+                    and previous_offset + (previous_end - previous_start) == local_offset):
+                runs[-1] = (previous_start, end, previous_offset)
+                continue
+        runs.append((start, end, local_offset))
+    return runs
+
+
+def main(argv=None):
+    """Write block index sidecars for the given files (for the patch server)."""
+    paths = sys.argv[1:] if argv is None else argv
+    if not paths:
+        print(f"Uso: python3 delta.py ARQUIVO... (gera ARQUIVO{BLOCK_INDEX_SUFFIX} para cada arquivo)", file=sys.stderr)
+        return 2
+    for path in paths:
+        print(write_block_index(path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+import contextlib
+
+from patcher import (
+    DEFAULT_DOWNLOAD_WORKERS, ContentStore, DiskWriter, Patcher, RateLimiter, StateStore, game_running, install_lock,
+    load_config,
+)
+from peer import PEER_PORT, PeerServer
+
+PREFETCH_INTERVAL = 15  # Minutes between checks for a new patch in --watch mode
+
+
+class JsonLinesReporter:
+    """Write patch events to a stream, one JSON object per line."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        """Write a single event."""
+        line = json.dumps({"event": event, "time": round(time.time(), 3), **fields}, ensure_ascii=False)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+def parse_args(argv):
+    """Parse the headless command line."""
+    parser = argparse.ArgumentParser(
+        prog="epic_launcher --headless",
+        description="Atualiza uma instalação do Epic! Shard sem interface gráfica.",
+    )
+    parser.add_argument("--headless", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--install-path", help="diretório da instalação (padrão: o salvo no config.json)")
+    parser.add_argument("--verify", action="store_true", help="recalcula o hash de todos os arquivos, ignorando o cache")
+    parser.add_argument("--no-delta", action="store_true", help="baixa arquivos alterados inteiros, sem o patch por blocos")
+    parser.add_argument("--rate-limit", type=float, help="limite de banda em MB/s (0 = sem limite)")
+    parser.add_argument("--workers", type=int, help="arquivos baixados ao mesmo tempo")
+    parser.add_argument("--server", help="servidor de download no formato hostname:porta")
+    parser.add_argument("--mirror", action="append", default=[],
+                        help="servidor alternativo no formato hostname:porta (repetível); o mais rápido é usado")
+    parser.add_argument("--peer", action="append", default=[],
+                        help="launcher da rede local para baixar os arquivos, no formato hostname:porta (repetível)")
+    parser.add_argument("--no-discovery", action="store_true", help="não procura launchers na rede local")
+    parser.add_argument("--serve", action="store_true",
+                        help="depois do patch, compartilha a instalação na rede local até ser interrompido")
+    parser.add_argument("--watch", action="store_true",
+                        help="fica em segundo plano baixando os patches novos e aplica quando o jogo não está aberto")
+    parser.add_argument("--interval", type=float,
+                        help=f"minutos entre as verificações do --watch (padrão: {PREFETCH_INTERVAL})")
+    parser.add_argument("--scan", action="store_true",
+                        help="só verifica a instalação contra o Manifest, sem baixar nada (com --verify, recalcula todos os hashes)")
+    return parser.parse_args(argv)
+
+
+def scan(patcher, started, out):
+    """Check the install without downloading and report the problems found. Returns the exit code."""
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            report = patcher.scan(on_issue=lambda kind, path: out.emit("issue", kind=kind, path=path))
+    except Exception as e:
+        out.emit("error", message=str(e), trace=patcher.trace_path)
+        return 2
+    if report is None or report["interrupted"]:
+        return 130
+
+    problems = len(report["missing"]) + len(report["wrong_size"]) + len(report["corrupt"]) + len(report["unreadable"])
+    out.emit(
+        "scanned", files=report["files"], ok=report["ok"], problems=problems, extra=len(report["extra"]),
+        elapsed=round(time.monotonic() - started, 3), trace=patcher.trace_path,
+    )
+    return 1 if problems else 0
+
+
+def watch(patcher, install_path, interval, stop_event, out):
+    """Prefetch new patches every interval seconds, applying them whenever the game isn't running."""
+    while not stop_event.is_set():
+        try:
+            # Keep stdout machine-readable: the patcher's log messages go to stderr
+            with contextlib.redirect_stdout(sys.stderr):
+                staged, failed_files = patcher.prefetch()
+                applied = False
+                if staged and not stop_event.is_set() and not game_running(install_path):
+                    with install_lock(install_path, blocking=False) as locked:
+                        applied = locked and patcher.apply_staged()
+                    patcher.save_hash_cache()
+            out.emit("prefetched", staged=staged, applied=applied, failed_files=failed_files, trace=patcher.trace_path)
+        except Exception as e:
+            out.emit("error", message=str(e), trace=patcher.trace_path)
+        stop_event.wait(interval)
+    return 0
+
+
+def main(argv=None):
+    """Run a patch without Qt, printing JSON lines on stdout. Returns the exit code."""
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    config = load_config()
+
+    install_path = args.install_path or config.get("install_path", "")
+    if not install_path:
+        print("Não há um diretório de destino. Use --install-path.", file=sys.stderr)
+        return 2
+    install_path = os.path.abspath(install_path)
+    os.makedirs(install_path, exist_ok=True)
+
+    base_url = None
+    if args.server:
+        hostname, _, port = args.server.rpartition(":")
+        if not hostname or not port.isdigit():
+            print("Coloque o servidor no formato: hostname:porta - exemplo: epic-shard.com:2595", file=sys.stderr)
+            return 2
+        base_url = f"http://{hostname}:{port}"
+
+    # Ctrl+C / SIGTERM stop the patch the same way the window's close button does
+    stop_event = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    rate_limit = args.rate_limit if args.rate_limit is not None else config.get("download_rate_limit", 0)
+
+    out = JsonLinesReporter(sys.stdout)
+    state_store = StateStore()
+    content_store = ContentStore.from_config(config)
+    patcher = Patcher(
+        install_path, state_store, stop_event.is_set,
+        args.workers or config.get("download_workers", DEFAULT_DOWNLOAD_WORKERS), args.verify,
+        base_url=base_url,
+        delta_patching=not args.no_delta and config.get("delta_patching", True),
+        rate_limiter=RateLimiter(rate_limit * 1024 * 1024),
+        content_store=content_store,
+        peers=args.peer + config.get("peers", []),
+        peer_discovery=not args.no_discovery and config.get("peer_discovery", True),
+        mirrors=args.mirror + config.get("mirrors", []),
+        writer=DiskWriter.from_config(config),
+        on_status=lambda message: out.emit("status", message=message),
+        on_hashing=lambda message: out.emit("hashing", message=message),
+        on_files_completed=lambda completed, total: out.emit("files", completed=completed, total=total),
+        on_total_size=lambda total_bytes: out.emit("total_size", bytes=total_bytes),
+        on_speed=lambda total_bytes, bytes_per_second: out.emit(
+            "progress", bytes=total_bytes, bytes_per_second=round(bytes_per_second)
+        ),
+    )
+
+    started = time.monotonic()
+    out.emit("start", install_path=install_path, server=patcher.base_url, verify=args.verify)
+    if args.scan:
+        try:
+            return scan(patcher, started, out)
+        finally:
+            state_store.close()
+            if content_store is not None:
+                content_store.close()
+
+    if args.watch:
+        interval = args.interval if args.interval is not None else config.get("prefetch_interval", PREFETCH_INTERVAL)
+        try:
+            return watch(patcher, install_path, interval * 60, stop_event, out)
+        finally:
+            state_store.close()
+            if content_store is not None:
+                content_store.close()
+
+    try:
+        # Keep stdout machine-readable: the patcher's log messages go to stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            success, failed_files = patcher.run()
+    except Exception as e:
+        out.emit("error", message=str(e), trace=patcher.trace_path)
+        return 2
+    finally:
+        state_store.close()
+        if content_store is not None:
+            content_store.close()
+
+    out.emit(
+        "finished", success=success, failed_files=failed_files, elapsed=round(time.monotonic() - started, 3),
+        trace=patcher.trace_path,
+    )
+    if not success:
+        return 130  # Interrupted
+    if failed_files:
+        return 1
+
+    if args.serve or config.get("peer_server", False):
+        # Only a fully verified install is shared
+        peer_server = PeerServer(install_path, config.get("peer_port", PEER_PORT))
+        with contextlib.redirect_stdout(sys.stderr):
+            peer_server.start()
+        out.emit("serving", port=peer_server.port)
+        stop_event.wait()
+        peer_server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
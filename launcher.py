@@ -1,18 +1,55 @@
 import os
 import json
-import hashlib
 import time
 import sys
 import shutil
-import socket
-import zipfile
-import requests
-from urllib.request import urlretrieve
+
+
+class StartupTimer:
+    """Measure how long each startup phase takes (enabled with --startup-timing)."""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases = []
+
+    def mark(self, phase):
+        """Close the current phase under the given name."""
+        if self.enabled:
+            now = time.perf_counter()
+            self.phases.append((phase, now - self.last))
+            self.last = now
+
+    def report(self):
+        """Print the duration of every phase and the total."""
+        if self.enabled:
+            for phase, duration in self.phases:
+                print(f"[startup] {phase}: {duration * 1000:.1f} ms", file=sys.stderr)
+            print(f"[startup] total: {(self.last - self.started) * 1000:.1f} ms", file=sys.stderr)
+
+
+startup_timer = StartupTimer(
+    "--startup-timing" in sys.argv[1:] or os.environ.get("EPIC_LAUNCHER_STARTUP_TIMING") == "1"
+)
+
+if __name__ == "__main__" and "--headless" in sys.argv[1:]:
+    # Patch without a display: never import Qt
+    from headless import main
+    sys.exit(main(sys.argv[1:]))
+
+from patcher import (
+    CONFIG_PATH, DEFAULT_DOWNLOAD_WORKERS, HTTP_TIMEOUT, ContentStore, DiskWriter, Patcher, RateLimiter, Staging,
+    StateStore, get_http_session, load_config, resolve_host, resolve_host_async
+)
 from PyQt5.QtWidgets import (
-    QApplication, QMainWindow, QLabel, QLineEdit, QPushButton, QProgressBar, QCheckBox, QFileDialog, QMessageBox
+    QApplication, QMainWindow, QLabel, QLineEdit, QPushButton, QProgressBar, QCheckBox, QFileDialog, QMessageBox,
+    QSpinBox
 )
 from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal, QObject
-from PyQt5.QtGui import QPixmap, QColor, QFont, QIcon, QMovie
+from PyQt5.QtGui import QPixmap, QFont, QIcon, QMovie
+
+startup_timer.mark("imports")
 
 
 # Determine if the application is running as a bundled executable
@@ -35,11 +72,8 @@ LOADING_GIF_PATH = os.path.join(base_path, "media", "loading.gif")  # Path to a
 SETTINGS_PATH = os.path.join(base_path, "config", "settings.json")
 SETTINGS_NO_RAZOR_PATH = os.path.join(base_path, "config", "settings_no_razor.json")
 
-CONFIG_PATH = os.path.expanduser("~/.epic_shard_launcher/config.json")
-STATE_PATH = os.path.expanduser("~/.epic_shard_launcher/state.json")
 SERVER_HOSTNAME = "epic-shard.com"
 SERVER_PORT = 2595
-SERVER_IP = socket.gethostbyname(SERVER_HOSTNAME)
 
 
 class DownloadWorker(QObject):
@@ -48,207 +82,47 @@ class DownloadWorker(QObject):
     hashing_file = pyqtSignal(str)  # Signal for hashing files
     download_finished = pyqtSignal(bool, list)  # Signal for when the download is finished
     error_occurred = pyqtSignal(str)  # Signal for errors
-    total_size_calculated = pyqtSignal(int)  # Signal for total download size
+    total_size_calculated = pyqtSignal(object)  # Signal for total download size (may exceed 32 bits)
+    speed_updated = pyqtSignal(object, float)  # Signal for total downloaded bytes and smoothed speed
 
-    def __init__(self, install_path, download_state, stop_download, download_start_time):
+    def __init__(self, install_path, state_store, stop_download, download_start_time,
+                 max_workers=DEFAULT_DOWNLOAD_WORKERS, deep_verify=False, delta_patching=True, rate_limiter=None,
+                 content_store=None, peers=(), peer_discovery=False, mirrors=(), writer=None):
         super().__init__()
         self.install_path = install_path
-        self.download_state = download_state
-        self.stop_download = stop_download
         self.download_start_time = download_start_time
-        self.total_downloaded_bytes = 0  # Initialize total downloaded bytes
+        # The patch pipeline itself lives in patcher.py so it can also run headless
+        self.patcher = Patcher(
+            install_path, state_store, stop_download, max_workers, deep_verify,
+            delta_patching=delta_patching, rate_limiter=rate_limiter, content_store=content_store,
+            peers=peers, peer_discovery=peer_discovery, mirrors=mirrors, writer=writer,
+            on_status=self.current_file_updated.emit,
+            on_hashing=self.hashing_file.emit,
+            on_file_progress=self.progress_updated.emit,
+            on_files_completed=self.progress_updated.emit,
+            on_total_size=self.total_size_calculated.emit,
+            on_speed=self.speed_updated.emit,
+        )
 
     def download_files(self):
         """Download files from the server."""
         try:
-            # Calculate the total download size
-            #total_size = self.calculate_total_download_size()
-            #self.total_size_calculated.emit(total_size)
-
-            # Proceed with downloading files
-            manifest_url = f"http://{SERVER_IP}:{SERVER_PORT}/Manifest"
-            hashes_url = f"http://{SERVER_IP}:{SERVER_PORT}/Hashes"
-
-            manifest_path = os.path.join(self.install_path, "Manifest")
-            hashes_path = os.path.join(self.install_path, "Hashes")
-
-            self.download_file(manifest_url, manifest_path)
-            self.download_file(hashes_url, hashes_path)
-
-            with open(manifest_path, "r") as f:
-                manifest_files = [line.strip() for line in f.readlines() if line.strip().startswith('/')]
-
-            with open(hashes_path, "r", encoding='utf-8-sig') as f:
-                hashes = {}
-                for line in f.readlines():
-                    line = line.strip()
-                    if line:
-                        parts = line.split('\t')
-                        if len(parts) >= 2:
-                            file_path = parts[0].strip()
-                            first_hash = parts[1].strip()
-                            hashes[file_path] = first_hash
-
-            pending_files = []
-            for file_path in manifest_files:
-                if file_path.startswith('/-'):
-                    continue
-
-                dir_path, file_name = os.path.split(file_path)
-
-                if file_name.startswith('+'):
-                    download_file_name = file_name[1:]
-                    download_file_path = os.path.join(dir_path, download_file_name)
-                    local_file_path = os.path.join(self.install_path, download_file_path.lstrip('/'))
-                else:
-                    download_file_path = file_path
-                    local_file_path = os.path.join(self.install_path, file_path.lstrip('/'))
-
-                if file_name.startswith('+'):
-                    if os.path.exists(local_file_path):
-                        continue
-
-                if download_file_path in self.download_state["downloaded_files"]:
-                    if os.path.exists(local_file_path):
-                        current_hash = self.calculate_md5(local_file_path)
-                        if current_hash.lower() == self.download_state["downloaded_files"][download_file_path].lower():
-                            continue
-                        else:
-                            print(f"Arquivo {file_path} está desatualizado ou corrompido. Rebaixando...")
-                    else:
-                        print(f"Arquivo {file_path} está faltando. Rebaixando...")
-                pending_files.append(file_path)
-
-            failed_files = []
-
-            for i, file_path in enumerate(pending_files):
-                if self.stop_download():
-                    break
-
-                self.current_file_updated.emit(f"Baixando: {file_path}")
-                try:
-                    self.download_or_update_file(file_path, hashes.get(file_path, ""))
-                except Exception as e:
-                    failed_files.append(file_path)
-
-                self.progress_updated.emit(i + 1, len(pending_files))
-
-            self.download_finished.emit(not self.stop_download(), failed_files)
+            # Resolved here, on the worker thread, so a slow or missing DNS never blocks the window
+            try:
+                server_ip = resolve_host(SERVER_HOSTNAME)
+                self.patcher.base_url = f"http://{server_ip}:{SERVER_PORT}"
+            except OSError as e:
+                if not self.patcher.mirrors:
+                    raise Exception(f"Erro ao resolver hostname {SERVER_HOSTNAME}: {e}")
+                # The mirrors can still patch; the main server is only dropped for this run
+                print(f"Erro ao resolver hostname {SERVER_HOSTNAME}, usando os servidores alternativos: {e}")
+                self.patcher.base_url = self.patcher.mirrors[0]
+
+            success, failed_files = self.patcher.run()
+            self.download_finished.emit(success, failed_files)
         except Exception as e:
             self.error_occurred.emit(str(e))
 
-    def calculate_total_download_size(self):
-        """Calculate the total size of all files to be downloaded."""
-        total_size = 0
-        manifest_url = f"http://{SERVER_IP}:{SERVER_PORT}/Manifest"
-        manifest_path = os.path.join(self.install_path, "Manifest")
-
-        try:
-            # Download the manifest file
-            urlretrieve(manifest_url, manifest_path)
-
-            # Read the manifest file
-            with open(manifest_path, "r") as f:
-                manifest_files = [line.strip() for line in f.readlines() if line.strip().startswith('/')]
-
-            # Calculate the total size of all files
-            for file_path in manifest_files:
-                if file_path.startswith('/-'):
-                    continue
-
-                file_url = f"http://{SERVER_IP}:{SERVER_PORT}/{file_path.lstrip('/')}"
-                response = requests.head(file_url)
-                if response.status_code == 200:
-                    total_size += int(response.headers.get("content-length", 0))
-
-        except Exception as e:
-            print(f"Erro ao calcular o tamanho total do download: {e}")
-
-        # Emit the total size
-        self.total_size_calculated.emit(total_size)
-        return total_size
-
-    def download_or_update_file(self, file_path, expected_hash):
-        """Download or update a file."""
-        dir_path, file_name = os.path.split(file_path)
-
-        if file_name.startswith('+'):
-            download_file_name = file_name[1:]
-            download_file_path = os.path.join(dir_path, download_file_name)
-            local_file_path = os.path.join(self.install_path, download_file_path.lstrip('/'))
-        else:
-            download_file_path = file_path
-            local_file_path = os.path.join(self.install_path, file_path.lstrip('/'))
-
-        os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-
-        if os.path.exists(local_file_path):
-            self.hashing_file.emit(f"Hashing: {file_path}")
-            current_hash = self.calculate_md5(local_file_path).lower()
-
-            if current_hash == expected_hash.lower():
-                self.download_state["downloaded_files"][download_file_path] = expected_hash
-                return
-            else:
-                print(f"Arquivo {file_path} está corrompido ou desatualizado. Hash esperado: {expected_hash}, Hash atual: {current_hash}")
-
-        self.current_file_updated.emit(f"Baixando: {file_path}")
-
-        file_url = f"http://{SERVER_IP}:{SERVER_PORT}/{download_file_path.lstrip('/')}"
-        try:
-            self.download_file(file_url, local_file_path)
-
-            self.hashing_file.emit(f"Hashing: {file_path}")
-            downloaded_hash = self.calculate_md5(local_file_path).lower()
-
-            if downloaded_hash == expected_hash.lower():
-                self.download_state["downloaded_files"][download_file_path] = expected_hash
-            else:
-                print(f"Erro: O arquivo baixado {download_file_path} está corrompido. Hash esperado: {expected_hash}, Hash baixado: {downloaded_hash}")
-                os.remove(local_file_path)
-                raise Exception(f"Arquivo {download_file_path} está corrompido após o download.")
-        except Exception as e:
-            print(f"Falha ao fazer o download de {file_path}: {e}")
-            raise
-        finally:
-            self.save_download_state()
-
-    def download_file(self, url, local_path):
-        """Download a file with progress tracking."""
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        total_size = int(response.headers.get("content-length", 0))
-        downloaded_bytes = 0
-
-        with open(local_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if self.stop_download():
-                    raise Exception("Download interrompido pelo jogador")
-
-                if chunk:
-                    f.write(chunk)
-                    downloaded_bytes += len(chunk)
-                    self.total_downloaded_bytes += len(chunk)  # Update total downloaded bytes
-
-                    # Emit progress update
-                    self.progress_updated.emit(downloaded_bytes, total_size)
-
-    def save_download_state(self):
-        """Save the download state to the state file."""
-        os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
-        with open(STATE_PATH, "w") as f:
-            json.dump(self.download_state, f)
-
-    @staticmethod
-    def calculate_md5(file_path):
-        """Calculate the MD5 hash of a file."""
-        hash_md5 = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
-
 
 class GameLauncher(QMainWindow):
     def __init__(self):
@@ -261,10 +135,23 @@ class GameLauncher(QMainWindow):
         self.background_label = QLabel(self)
         self.background_label.setPixmap(self.background)
         self.background_label.setGeometry(0, 0, 659, 519)
+        startup_timer.mark("background")
 
         # Initialize variables
-        self.install_path = self.load_install_path()
-        self.download_state = self.load_download_state()
+        config = self.load_config()
+        self.install_path = config.get("install_path", "")
+        self.download_workers = config.get("download_workers", DEFAULT_DOWNLOAD_WORKERS)
+        self.delta_patching = config.get("delta_patching", True)
+        # Shared with the running patch, so changing the limit takes effect immediately
+        self.rate_limit = config.get("download_rate_limit", 0)  # MB/s, 0 = unlimited
+        self.rate_limiter = RateLimiter(self.rate_limit * 1024 * 1024)
+        self.state_store = None  # Opened when the first patch starts
+        self.content_store = None  # Same, and stays None if disabled in config.json
+        self.peers = config.get("peers", [])  # LAN launchers to download from, "host:port"
+        self.peer_discovery = config.get("peer_discovery", True)
+        self.mirrors = config.get("mirrors", [])  # Alternative patch servers, "host:port"
+        self.writer = DiskWriter.from_config(config)  # Chunk/buffer sizes, preallocation and fsync policy
+        self.peer_server = None  # Shares the install on the LAN after a successful patch, if enabled
         self.stop_download = False
         self.download_thread = None
         self.download_worker = None
@@ -275,43 +162,22 @@ class GameLauncher(QMainWindow):
 
         # Create widgets
         self.create_widgets()
+        startup_timer.mark("widgets")
 
-    def load_install_path(self):
-        """Load the installation path from the config file."""
-        if os.path.exists(CONFIG_PATH):
-            with open(CONFIG_PATH, "r") as f:
-                data = json.load(f)
-                return data.get("install_path", "")
-        return ""
-
-    def load_download_state(self):
-        """Load the download state from the state file."""
-        if os.path.exists(STATE_PATH):
-            with open(STATE_PATH, "r") as f:
-                return json.load(f)
-        return {"downloaded_files": {}, "pending_files": []}
-
-    def save_download_state(self):
-        """Save the download state to the state file."""
-        os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
-        with open(STATE_PATH, "w") as f:
-            json.dump(self.download_state, f)
-
-    def get_background_color_at(self, x, y):
-        """Get the background color at a specific position."""
-        try:
-            # Convert QPixmap to QImage to access pixel data
-            image = self.background.toImage()
-            color = QColor(image.pixel(x, y))
-            return f"rgb({color.red()}, {color.green()}, {color.blue()})"
-        except Exception as e:
-            print(f"Failed to get background color: {e}")
-            return "black"
+        # Resolve the download server while the player looks at the window
+        resolve_host_async(SERVER_HOSTNAME)
+
+    def load_config(self):
+        """Load the launcher config file."""
+        return load_config()
+
+    def load_state_store(self):
+        """Open the download state database, migrating state.json if needed."""
+        return StateStore()
 
     def create_widgets(self):
         """Create all the widgets for the launcher."""
         text_color = "white"
-        bg_color = self.get_background_color_at(80, 230)
 
         # Style for buttons
         button_style = """
@@ -331,18 +197,18 @@ class GameLauncher(QMainWindow):
 
         # Server Info
         self.server_info_label = QLabel("Servidor de Download:", self)
-        self.server_info_label.setGeometry(385, 400, 200, 20)
+        self.server_info_label.setGeometry(385, 375, 200, 20)
         self.server_info_label.setStyleSheet(f"color: {text_color}; background: transparent;")
 
         self.server_info_text = QLineEdit(f"{SERVER_HOSTNAME}:{SERVER_PORT}", self)
-        self.server_info_text.setGeometry(385, 420, 215, 20)
+        self.server_info_text.setGeometry(385, 395, 215, 20)
         self.server_info_text.setReadOnly(True)
         self.server_info_text.setStyleSheet(
             f"background: rgba(255, 255, 255, 100); color: {text_color}; border-radius: 5px; padding: 5px;"
         )
 
         self.edit_save_button = QPushButton(self)
-        self.edit_save_button.setGeometry(575, 420, 30, 20)
+        self.edit_save_button.setGeometry(575, 395, 30, 20)
         self.edit_save_button.setIcon(QIcon(PENCIL_ICON_PATH))
         self.edit_save_button.setStyleSheet(
             "background: transparent; border: none;"
@@ -351,11 +217,11 @@ class GameLauncher(QMainWindow):
 
         # Install Path
         self.install_path_label = QLabel("Caminho da Instalação:", self)
-        self.install_path_label.setGeometry(50, 400, 200, 20)
+        self.install_path_label.setGeometry(50, 375, 200, 20)
         self.install_path_label.setStyleSheet(f"color: {text_color}; background: transparent;")
 
         self.folder_button = QPushButton(self)
-        self.folder_button.setGeometry(45, 420, 30, 20)
+        self.folder_button.setGeometry(45, 395, 30, 20)
         self.folder_button.setIcon(QIcon(FOLDER_ICON_PATH))
         self.folder_button.setStyleSheet( 
             "background: transparent; border: none;"
@@ -363,31 +229,31 @@ class GameLauncher(QMainWindow):
         self.folder_button.clicked.connect(self.select_install_folder)
 
         self.path_label = QLabel(self.install_path or "Não definido", self)
-        self.path_label.setGeometry(75, 420, 200, 20)
+        self.path_label.setGeometry(75, 395, 200, 20)
         self.path_label.setStyleSheet(f"color: {text_color}; background: transparent;")
 
         # Progress Bars
-        #self.overall_progress_label = QLabel("Progresso Total:", self)
-        #self.overall_progress_label.setGeometry(50, 425, 200, 20)
-        #self.overall_progress_label.setStyleSheet(f"color: {text_color}; background: transparent;")
-
-        #self.overall_progress_bar = QProgressBar(self)
-        #self.overall_progress_bar.setGeometry(200, 425, 400, 20)
-        #self.overall_progress_bar.setStyleSheet(
-        #    """
-        #    QProgressBar {
-        #        border: 1px solid grey;
-        #        border-radius: 5px;
-        #        background: rgba(255, 255, 255, 100);
-        #        text-align: right;
-        #        color: white;
-        #    }
-        #    QProgressBar::chunk {
-        #        background: #6c42a7;
-        #        border-radius: 5px;
-        #    }
-        #    """
-        #)
+        self.overall_progress_label = QLabel("Progresso Total:", self)
+        self.overall_progress_label.setGeometry(50, 421, 200, 20)
+        self.overall_progress_label.setStyleSheet(f"color: {text_color}; background: transparent;")
+
+        self.overall_progress_bar = QProgressBar(self)
+        self.overall_progress_bar.setGeometry(200, 421, 400, 20)
+        self.overall_progress_bar.setStyleSheet(
+            """
+            QProgressBar {
+                border: 1px solid grey;
+                border-radius: 5px;
+                background: rgba(255, 255, 255, 100);
+                text-align: right;
+                color: white;
+            }
+            QProgressBar::chunk {
+                background: #6c42a7;
+                border-radius: 5px;
+            }
+            """
+        )
 
         self.file_progress_label = QLabel("Progresso do Arquivo:", self)
         self.file_progress_label.setGeometry(50, 446, 200, 20)
@@ -413,7 +279,7 @@ class GameLauncher(QMainWindow):
 
         # Buttons
         self.start_update_button = QPushButton("Patch", self)
-        self.start_update_button.setGeometry(250, 330, 150, 50)
+        self.start_update_button.setGeometry(250, 315, 150, 50)
         self.start_update_button.setStyleSheet(button_style)
         self.start_update_button.clicked.connect(self.start_update)
 
@@ -432,6 +298,30 @@ class GameLauncher(QMainWindow):
         self.razor_checkbox.setStyleSheet(f"color: {text_color}; background: transparent;")
         self.razor_checkbox.setChecked(True)  # Enabled by default
 
+        # Deep Verify Checkbox
+        self.deep_verify_checkbox = QCheckBox("Verificação completa", self)
+        self.deep_verify_checkbox.setToolTip("Recalcula o hash de todos os arquivos, ignorando o cache")
+        self.deep_verify_checkbox.setGeometry(385, 490, 220, 20)
+        self.deep_verify_checkbox.setStyleSheet(f"color: {text_color}; background: transparent;")
+        self.deep_verify_checkbox.setChecked(False)  # Use the hash cache by default
+
+        # Bandwidth Limit, next to the Patch button: the row above the checkboxes shows the current file and speed
+        self.rate_limit_label = QLabel("Banda:", self)
+        self.rate_limit_label.setGeometry(408, 345, 60, 20)
+        self.rate_limit_label.setStyleSheet(f"color: {text_color}; background: transparent;")
+
+        self.rate_limit_spinbox = QSpinBox(self)
+        self.rate_limit_spinbox.setGeometry(470, 345, 130, 20)
+        self.rate_limit_spinbox.setRange(0, 1000)
+        self.rate_limit_spinbox.setSuffix(" MB/s")
+        self.rate_limit_spinbox.setSpecialValueText("Sem limite")  # Shown for 0
+        self.rate_limit_spinbox.setToolTip("Limita a velocidade do download, mesmo durante o patch")
+        self.rate_limit_spinbox.setStyleSheet(
+            f"background: rgba(255, 255, 255, 100); color: {text_color}; border-radius: 5px;"
+        )
+        self.rate_limit_spinbox.setValue(int(self.rate_limit))
+        self.rate_limit_spinbox.valueChanged.connect(self.set_rate_limit)
+
         # Close Button
         self.close_button = QPushButton(self)
         self.close_button.setGeometry(580, 20, 30, 30)
@@ -469,17 +359,15 @@ class GameLauncher(QMainWindow):
                 if not (0 < port <= 65535):
                     raise ValueError("Porta deve estar entre 1 e 65535")
 
-                global SERVER_HOSTNAME, SERVER_PORT, SERVER_IP
+                global SERVER_HOSTNAME, SERVER_PORT
                 SERVER_HOSTNAME = hostname
                 SERVER_PORT = port
-                SERVER_IP = socket.gethostbyname(SERVER_HOSTNAME)
+                resolve_host_async(SERVER_HOSTNAME)
                 self.server_info_text.setReadOnly(True)
                 self.edit_save_button.setIcon(QIcon(PENCIL_ICON_PATH))
                 self.edit_mode = False
             except ValueError as e:
                 QMessageBox.critical(self, "Erro", f"Formato inválido: {e}\nColoque no formato: hostname:porta - exemplo: epic-shard.com:2595")
-            except Exception as e:
-                QMessageBox.critical(self, "Erro", f"Erro ao resolver hostname: {e}")
 
     def select_install_folder(self):
         """Select the installation folder."""
@@ -493,9 +381,21 @@ class GameLauncher(QMainWindow):
 
     def save_install_path(self):
         """Save the installation path to the config file."""
+        self.save_config(install_path=self.install_path)
+
+    def save_config(self, **values):
+        """Merge values into the config file."""
+        config = self.load_config()
+        config.update(values)
         os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
         with open(CONFIG_PATH, "w") as f:
-            json.dump({"install_path": self.install_path}, f)
+            json.dump(config, f)
+
+    def set_rate_limit(self, megabytes_per_second):
+        """Apply and save the bandwidth limit."""
+        self.rate_limit = megabytes_per_second
+        self.rate_limiter.set_rate(megabytes_per_second * 1024 * 1024)
+        self.save_config(download_rate_limit=megabytes_per_second)
 
     def start_update(self):
         """Start the update process."""
@@ -511,27 +411,37 @@ class GameLauncher(QMainWindow):
         self.loading_movie.start()
 
         # Update the current file label to indicate processing
-        self.current_file_label.setText("Calculando tamanho do download... (isso pode demorar alguns segundos)")
+        self.current_file_label.setText("Verificando arquivos...")
 
         # Initialize variables
+        if self.state_store is None:
+            self.state_store = self.load_state_store()
+            self.content_store = ContentStore.from_config(self.load_config())
+        if self.peer_server is not None:
+            self.peer_server.paused = True  # Don't share files while they're being patched
         self.stop_download = False
         self.download_start_time = time.time()
-        self.total_downloaded_bytes = 0  # Reset total downloaded bytes
+        self.total_download_size = 0  # Unknown until the worker reports it
+        self.overall_progress_bar.setValue(0)
+        self.overall_progress_bar.setFormat("%p%")
 
         # Create a QThread and DownloadWorker
         self.download_thread = QThread()
         self.download_worker = DownloadWorker(
-            self.install_path, self.download_state, lambda: self.stop_download, self.download_start_time
+            self.install_path, self.state_store, lambda: self.stop_download, self.download_start_time,
+            self.download_workers, self.deep_verify_checkbox.isChecked(), self.delta_patching, self.rate_limiter,
+            self.content_store, self.peers, self.peer_discovery, self.mirrors, self.writer
         )
         self.download_worker.moveToThread(self.download_thread)
 
         # Connect signals and slots
         self.download_worker.progress_updated.connect(self.update_progress)
+        self.download_worker.speed_updated.connect(self.update_speed)
         self.download_worker.current_file_updated.connect(self.current_file_label.setText)
         self.download_worker.hashing_file.connect(self.current_file_label.setText)
         self.download_worker.download_finished.connect(self.on_download_finished)
         self.download_worker.error_occurred.connect(self.on_download_error)
-        #self.download_worker.total_size_calculated.connect(self.set_total_download_size)
+        self.download_worker.total_size_calculated.connect(self.set_total_download_size)
 
         # Start the download thread
         self.download_thread.started.connect(self.download_worker.download_files)
@@ -555,7 +465,8 @@ class GameLauncher(QMainWindow):
             self.start_update_button.setEnabled(True)
 
             # Set overall progress bar to 100%
-            # self.overall_progress_bar.setValue(100)
+            self.overall_progress_bar.setValue(100)
+            self.overall_progress_bar.setFormat("%p%")
 
             self.current_file_label.setText("Concluído!")
             self.download_speed_label.setText("")
@@ -571,6 +482,9 @@ class GameLauncher(QMainWindow):
 
             # Perform post-download tasks
             self.post_download_tasks()
+            # Like headless: an install whose files don't all match its Hashes isn't shared, the server stays paused
+            if not failed_files:
+                self.share_install()
             
             # Disconnect any previous connections to avoid multiple connections
             try:
@@ -582,6 +496,7 @@ class GameLauncher(QMainWindow):
             self.start_update_button.clicked.connect(self.launch_game)
         else:
             self.start_update_button.setEnabled(True)
+            self.resume_sharing()  # Stopped: the install is untouched
 
         # Clean up the download thread
         if self.download_thread and self.download_thread.isRunning():
@@ -596,6 +511,40 @@ class GameLauncher(QMainWindow):
 
         QMessageBox.critical(self, "Erro de Download", error_message)
         self.start_update_button.setEnabled(True)
+        self.resume_sharing()
+
+    def share_install(self):
+        """Share the verified install with other launchers on the LAN, if enabled in config.json."""
+        config = self.load_config()
+        if not config.get("peer_server", False):
+            return
+        # Imported on first use, like requests: peer pulls in http.server
+        from peer import PEER_PORT, PeerServer
+
+        try:
+            if self.peer_server is None or self.peer_server.install_path != self.install_path:
+                if self.peer_server is not None:
+                    self.peer_server.stop()
+                self.peer_server = PeerServer(self.install_path, config.get("peer_port", PEER_PORT))
+                self.peer_server.start()
+            else:
+                self.peer_server.refresh()
+            self.peer_server.paused = False
+        except OSError as e:
+            self.peer_server = None
+            print(f"Erro ao compartilhar a instalação na rede local: {e}")
+
+    def resume_sharing(self):
+        """Share the install again after a patch that stopped or failed, unless it left the install half patched."""
+        if self.peer_server is None or self.peer_server.install_path != self.install_path:
+            return
+        if Staging(self.install_path).load_journal() is not None:
+            return  # A commit was cut short: the install is half patched until the next run finishes it
+        try:
+            self.peer_server.refresh()  # In case the error came after the commit
+            self.peer_server.paused = False
+        except OSError as e:
+            print(f"Erro ao compartilhar a instalação na rede local: {e}")
 
     def post_download_tasks(self):
         """Perform tasks after all files are downloaded."""
@@ -616,7 +565,13 @@ class GameLauncher(QMainWindow):
         os.makedirs(razor_extract_path, exist_ok=True)
 
         try:
-            urlretrieve(razor_url, razor_zip_path)
+            import zipfile
+
+            with get_http_session().get(razor_url, stream=True, timeout=HTTP_TIMEOUT) as response:
+                response.raise_for_status()
+                with open(razor_zip_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        f.write(chunk)
             with zipfile.ZipFile(razor_zip_path, 'r') as zip_ref:
                 zip_ref.extractall(razor_extract_path)
             os.remove(razor_zip_path)
@@ -705,7 +660,12 @@ class GameLauncher(QMainWindow):
             self.download_thread.quit()
             self.download_thread.wait()
 
-        self.save_download_state()
+        if self.state_store is not None:
+            self.state_store.close()
+        if self.content_store is not None:
+            self.content_store.close()
+        if self.peer_server is not None:
+            self.peer_server.stop()
         event.accept()
 
     def start_countdown(self):
@@ -724,27 +684,35 @@ class GameLauncher(QMainWindow):
         countdown(15)
 
     def update_progress(self, downloaded_bytes, total_bytes):
-        """Update progress bars and download speed label."""
+        """Update the file progress bar."""
         if total_bytes > 0:
-            # Update file progress bar
             file_progress = int((downloaded_bytes / total_bytes) * 100)
             self.file_progress_bar.setValue(file_progress)
 
-            # Update overall progress bar
-            #if self.total_download_size > 0:
-            #    overall_progress = int((self.download_worker.total_downloaded_bytes / self.total_download_size) * 100)
-            #    self.overall_progress_bar.setValue(overall_progress)
-            #    print(f"Overall progress: {overall_progress}%")
+    def update_speed(self, total_downloaded_bytes, bytes_per_second):
+        """Update the overall progress bar, download speed label and ETA."""
+        if self.total_download_size > 0:
+            overall_progress = min(int((total_downloaded_bytes / self.total_download_size) * 100), 100)
+            self.overall_progress_bar.setValue(overall_progress)
+
+        self.download_speed_label.setText(f" {bytes_per_second / (1024 * 1024):.2f} MB/s")
 
-            # Update download speed label
-            elapsed_time = time.time() - self.download_start_time
-            if elapsed_time > 0:
-                download_speed = self.download_worker.total_downloaded_bytes / (1024 * 1024 * elapsed_time)
-                self.download_speed_label.setText(f" {download_speed:.2f} MB/s")
+        if self.total_download_size > 0 and bytes_per_second > 0:
+            remaining_bytes = max(self.total_download_size - total_downloaded_bytes, 0)
+            minutes, seconds = divmod(int(remaining_bytes / bytes_per_second), 60)
+            self.overall_progress_bar.setFormat(f"%p% - {minutes}:{seconds:02d} restantes")
 
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    startup_timer.mark("QApplication")
     launcher = GameLauncher()
     launcher.show()
+    startup_timer.mark("show")
+
+    def first_event_loop_pass():
+        startup_timer.mark("first paint")
+        startup_timer.report()
+
+    QTimer.singleShot(0, first_event_loop_pass)
     sys.exit(app.exec_())
@@ -0,0 +1,201 @@
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer
+
+from compress import SIDECAR_SUFFIXES, compress_tree, write_sidecar
+from delta import BLOCK_INDEX_SUFFIX, DELTA_MIN_SIZE, write_block_index
+from peer import PatchRequestHandler
+
+
+def parse_size_distribution(spec):
+    """Return a size sampler for "fixed:SIZE", "uniform:MIN:MAX", "lognormal:MEDIAN:SIGMA" or "uo"."""
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(":")] if args else []
+    if kind == "fixed":
+        return lambda rng: int(values[0])
+    if kind == "uniform":
+        return lambda rng: rng.randint(int(values[0]), int(values[1]))
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda rng: max(1, int(rng.lognormvariate(0, sigma) * median))
+    if kind == "uo":
+        # Like a ClassicUO install: mostly small files plus a few huge .mul/.uop maps
+        return lambda rng: rng.randint(50_000_000, 150_000_000) if rng.random() < 0.01 else int(rng.lognormvariate(0, 1.5) * 20_000)
+    raise ValueError(f"Distribuição de tamanho desconhecida: {spec}")
+
+
+def generate_tree(root, files=1000, size_distribution="lognormal:20000:1.5", seed=0, blocks=True,
+                  redundancy=0.0, compression=None):
+    """Create a synthetic patch tree with /Manifest and /Hashes under root. Returns the total bytes.
+
+    With blocks, files of at least DELTA_MIN_SIZE also get a block index sidecar for delta patching.
+    redundancy is the fraction of every file made of zeros, so it compresses like real data files; with a
+    compression format the files also get compressed sidecars.
+    """
+    rng = random.Random(seed)
+    sample_size = parse_size_distribution(size_distribution)
+    total_bytes = 0
+    manifest_lines = []
+    hashes_lines = []
+
+    for i in range(files):
+        file_path = f"/ClassicUO/Data/dir{i % 32:02d}/file{i:05d}.mul"
+        local_path = os.path.join(root, file_path.lstrip('/'))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+        size = sample_size(rng)
+        hash_md5 = hashlib.md5()
+        with open(local_path, "wb") as f:
+            remaining = size
+            while remaining > 0:
+                size_chunk = min(remaining, 1024 * 1024)
+                zeros = int(size_chunk * redundancy)
+                chunk = rng.randbytes(size_chunk - zeros) + bytes(zeros)
+                f.write(chunk)
+                hash_md5.update(chunk)
+                remaining -= len(chunk)
+
+        if blocks and size >= DELTA_MIN_SIZE:
+            write_block_index(local_path)
+
+        total_bytes += size
+        manifest_lines.append(file_path)
+        hashes_lines.append(f"{file_path}\t{hash_md5.hexdigest()}")
+
+    with open(os.path.join(root, "Manifest"), "w") as f:
+        f.write("\n".join(manifest_lines) + "\n")
+    with open(os.path.join(root, "Hashes"), "w") as f:
+        f.write("\n".join(hashes_lines) + "\n")
+    if compression:
+        compress_tree(root, compression)
+    return total_bytes
+
+
+def mutate_tree(root, fraction=0.1, seed=1):
+    """Overwrite a few KiB in place in a fraction of the files, like a server-side patch. Returns the count changed."""
+    rng = random.Random(seed)
+    with open(os.path.join(root, "Hashes")) as f:
+        hashes_lines = f.read().splitlines()
+
+    changed = 0
+    for i, line in enumerate(hashes_lines):
+        file_path, _, *flags = line.split("\t")
+        local_path = os.path.join(root, file_path.lstrip('/'))
+        size = os.path.getsize(local_path)
+        if not size or rng.random() >= fraction:
+            continue
+
+        patch_size = min(size, 4096)
+        with open(local_path, "r+b") as f:
+            f.seek(rng.randint(0, size - patch_size))
+            f.write(rng.randbytes(patch_size))
+        if os.path.exists(local_path + BLOCK_INDEX_SUFFIX):
+            write_block_index(local_path)
+        for compression, suffix in SIDECAR_SUFFIXES.items():
+            if os.path.exists(local_path + suffix):
+                write_sidecar(local_path, compression)
+
+        hash_md5 = hashlib.md5()
+        with open(local_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hash_md5.update(chunk)
+        hashes_lines[i] = "\t".join([file_path, hash_md5.hexdigest()] + flags)
+        changed += 1
+
+    with open(os.path.join(root, "Hashes"), "w") as f:
+        f.write("\n".join(hashes_lines) + "\n")
+    return changed
+
+
+class BandwidthLimiter:
+    """Pace writes from all connections to a shared bytes-per-second budget."""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def wait(self, nbytes):
+        """Block until nbytes may be sent."""
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / self.bytes_per_second
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MockRequestHandler(PatchRequestHandler):
+    """Serve a directory like the patch server, with added latency and a bandwidth cap."""
+
+    root = "."
+    latency = 0.0  # Seconds added before every response
+    limiter = BandwidthLimiter(0)
+
+    def resolve(self, path):
+        root = os.path.abspath(self.root)
+        local_path = os.path.abspath(os.path.join(root, path.lstrip('/')))
+        return local_path if local_path.startswith(root + os.sep) else None
+
+    def send_head(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return super().send_head()
+
+    def throttle(self, nbytes):
+        self.limiter.wait(nbytes)
+
+
+def start_server(root, port=0, latency=0.0, bandwidth=0):
+    """Serve root on 127.0.0.1 from a background thread. Returns the server; its port is server.server_port."""
+    handler = type("Handler", (MockRequestHandler,), {
+        "root": root, "latency": latency, "limiter": BandwidthLimiter(bandwidth),
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    """Generate and/or serve a synthetic patch tree."""
+    parser = argparse.ArgumentParser(description="Servidor de patch local para testes e benchmarks.")
+    parser.add_argument("--root", required=True, help="diretório servido (Manifest, Hashes e arquivos)")
+    parser.add_argument("--port", type=int, default=2595)
+    parser.add_argument("--generate", action="store_true", help="gera uma árvore sintética em --root antes de servir")
+    parser.add_argument("--files", type=int, default=1000, help="quantidade de arquivos gerados")
+    parser.add_argument("--size-dist", default="lognormal:20000:1.5",
+                        help="fixed:SIZE, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA ou uo")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-blocks", action="store_true", help="não gera os índices de blocos (patch por blocos)")
+    parser.add_argument("--redundancy", type=float, default=0.0, help="fração de zeros em cada arquivo (0 a 1)")
+    parser.add_argument("--compress", choices=sorted(SIDECAR_SUFFIXES), help="gera cópias comprimidas dos arquivos")
+    parser.add_argument("--latency", type=float, default=0.0, help="atraso por requisição, em segundos")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="limite de banda total, em MB/s (0 = sem limite)")
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        total_bytes = generate_tree(args.root, args.files, args.size_dist, args.seed, not args.no_blocks,
+                                    args.redundancy, args.compress)
+        print(f"Gerados {args.files} arquivos ({total_bytes / (1024 * 1024):.1f} MB) em {args.root}")
+
+    server = start_server(args.root, args.port, args.latency, args.bandwidth * 1024 * 1024)
+    print(f"Servindo {args.root} em http://127.0.0.1:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
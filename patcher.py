@@ -0,0 +1,2307 @@
+import os
+import sys
+import json
+import errno
+import hashlib
+import time
+import pickle
+import shutil
+import socket
+import sqlite3
+import heapq
+import threading
+import contextlib
+import urllib.parse
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+import delta
+import compress
+
+
+CONFIG_PATH = os.path.expanduser("~/.epic_shard_launcher/config.json")
+STATE_PATH = os.path.expanduser("~/.epic_shard_launcher/state.json")  # Legacy JSON state, migrated to STATE_DB_PATH
+STATE_DB_PATH = os.path.expanduser("~/.epic_shard_launcher/state.db")
+HASH_CACHE_PATH = os.path.expanduser("~/.epic_shard_launcher/hash_cache.json")
+SYNC_STATE_PATH = os.path.expanduser("~/.epic_shard_launcher/sync_state.json")
+MANIFEST_CACHE_PATH = os.path.expanduser("~/.epic_shard_launcher/manifest_cache.pickle")
+MANIFEST_CACHE_VERSION = 3  # Bumped when ManifestEntry changes, invalidating older caches
+TRACE_DIR = os.path.expanduser("~/.epic_shard_launcher/traces")
+CONTENT_STORE_PATH = os.path.expanduser("~/.epic_shard_launcher/store")  # Files by MD5, shared by every install
+CONTENT_STORE_MAX_SIZE = 8 * 1024  # MB kept in the content store before the least recently used files go
+CONTENT_STORE_LINK_MODES = ("auto", "reflink", "hardlink", "copy")
+TRACE_KEEP = 20  # Trace files kept in TRACE_DIR, oldest are deleted
+LOCK_DIR = os.path.expanduser("~/.epic_shard_launcher/locks")  # One lock file per install path
+STAGING_DIR_NAME = ".epic_staging"  # Inside the install, so staged files are moved into place with a rename
+SCAN_WALK_WORKERS = 8  # Directories listed at the same time by the integrity scan
+SERVER_HOSTNAME = "epic-shard.com"
+SERVER_PORT = 2595
+DEFAULT_DOWNLOAD_WORKERS = 4  # Number of files fetched at the same time
+HASH_WORKERS = os.cpu_count() or 4  # Files hashed at the same time (hashlib releases the GIL)
+HASH_BUFFER_SIZE = 1024 * 1024  # Read size used when hashing files
+HEAD_WORKERS = 8  # Concurrent HEAD requests used to size the pending downloads
+PROGRESS_UPDATE_INTERVAL = 0.1  # Seconds between progress reports (10 Hz)
+SPEED_WINDOW = 5.0  # Seconds of history used for the download speed and ETA
+RATE_LIMIT_BURST = 0.25  # Seconds of traffic the rate limiter lets through at once
+UNKNOWN_FILE_SIZE = 1024 * 1024  # Size assumed for scheduling until the HEAD request answers
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # Bytes read from the connection at a time
+WRITE_BUFFER_SIZE = 1024 * 1024  # Write buffer of the files being downloaded
+# Smallest write buffer, also used for 0: a raw file's write() may take only part of a chunk, a BufferedWriter
+# writes the rest. Chunks bigger than the buffer still go straight to the file.
+WRITE_BUFFER_MIN_SIZE = 8 * 1024
+PREALLOCATE_MIN_SIZE = 1024 * 1024  # Smaller downloads aren't worth reserving disk space for up front
+FSYNC_POLICIES = ("none", "commit", "always")
+FALLOC_FL_KEEP_SIZE = 0x01
+
+# Download priority: the client first, then the data files it loads at startup, then everything else
+CLIENT_DIR = "/ClassicUO/"
+CLIENT_DATA_DIR = "/ClassicUO/Data/"
+
+# HTTP connection settings
+HTTP_POOL_SIZE = 10  # Keep-alive connections kept open per host
+HTTP_RETRIES = 3  # Retries for failed connections and 5xx responses
+HTTP_BACKOFF_FACTOR = 0.5  # Sleep between retries: 0.5s, 1s, 2s...
+HTTP_TIMEOUT = (5, 30)  # (connect, read) timeout in seconds
+DNS_CACHE_TTL = 300  # Seconds a resolved server address is reused
+MIRROR_PROBE_TIMEOUT = (2, 5)  # (connect, read) timeout of the mirror speed test
+MIRROR_RANKING_TTL = 600  # Seconds a mirror ranking is reused by later patches
+MIRROR_PROBE_SIZE = 64 * 1024  # Bytes of Hashes fetched by the mirror speed test, not the whole file
+
+
+def load_config():
+    """Load the launcher config file."""
+    if os.path.exists(CONFIG_PATH):
+        with open(CONFIG_PATH, "r") as f:
+            return json.load(f)
+    return {}
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+_dns_cache = {}  # hostname -> (ip, expires_at)
+_dns_cache_lock = threading.Lock()
+_mirror_rankings = {}  # tuple of server URLs -> (ranked list, expires_at)
+
+
+def resolve_host(hostname, ttl=DNS_CACHE_TTL):
+    """Resolve a hostname to an IP address, reusing the answer for ttl seconds."""
+    now = time.monotonic()
+    with _dns_cache_lock:
+        cached = _dns_cache.get(hostname)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    ip = socket.gethostbyname(hostname)
+    with _dns_cache_lock:
+        _dns_cache[hostname] = (ip, now + ttl)
+    return ip
+
+
+def resolve_host_async(hostname):
+    """Warm the DNS cache in the background; failures surface when the address is needed."""
+    def work():
+        try:
+            resolve_host(hostname)
+        except OSError as e:
+            print(f"Erro ao resolver {hostname}: {e}")
+
+    threading.Thread(target=work, daemon=True).start()
+
+
+def get_http_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR):
+    """Return the shared keep-alive session used for every request to the servers."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None or _http_session.pool_size < pool_size:
+            # Imported on first use so the launcher window doesn't wait for requests to load
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("GET", "HEAD"),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.pool_size = pool_size
+            if _http_session is not None:
+                _http_session.close()
+            _http_session = session
+        return _http_session
+
+
+@contextlib.contextmanager
+def install_lock(install_path, blocking=True, stop=None, on_wait=None):
+    """Hold the lock that keeps two patches (window, headless, prefetch) off the same install.
+
+    Yields False instead of waiting if blocking is False, or once stop() returns True while waiting.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield True  # No flock on this platform
+        return
+
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    name = hashlib.md5(os.path.abspath(install_path).encode()).hexdigest()
+    with open(os.path.join(LOCK_DIR, f"{name}.lock"), "w") as f:
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not blocking or (stop is not None and stop()):
+                    yield False
+                    return
+                if not waiting and on_wait is not None:
+                    on_wait()
+                waiting = True
+                time.sleep(1)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def game_running(install_path):
+    """Return True if a ClassicUO from this install is running."""
+    client_dir = os.path.realpath(os.path.join(install_path, CLIENT_DIR.strip("/"))) + os.sep
+    if os.path.isdir("/proc"):
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                executable = os.readlink(f"/proc/{pid}/exe")
+            except OSError:
+                continue  # Gone, or another user's process
+            if executable.startswith(client_dir):
+                return True
+        return False
+
+    # macOS has no /proc; ps prints the executable's full path
+    import subprocess
+    try:
+        output = subprocess.run(["ps", "-axo", "comm="], capture_output=True, text=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return True  # When in doubt, leave the install alone
+    return any(line.strip().startswith(client_dir) for line in output.splitlines())
+
+
+def walk_files(root, skip=(), max_workers=SCAN_WALK_WORKERS):
+    """List every file under root with os.scandir, several directories at a time.
+
+    Returns {"/relative/path": stat_result}; directories whose relative path is in skip are not entered.
+    """
+    def list_directory(relative_dir, path):
+        files = {}
+        subdirs = []
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                relative_path = f"{relative_dir}/{dir_entry.name}"
+                if dir_entry.is_dir(follow_symlinks=False):
+                    if relative_path not in skip:
+                        subdirs.append((relative_path, dir_entry.path))
+                elif dir_entry.is_file():
+                    files[relative_path] = dir_entry.stat()
+        return files, subdirs
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(list_directory, "", root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    files, subdirs = future.result()
+                except OSError as e:
+                    print(f"Erro ao listar {e.filename}: {e}")
+                    continue
+                found.update(files)
+                pending.update(executor.submit(list_directory, *subdir) for subdir in subdirs)
+    return found
+
+
+class HashCache:
+    """Persistent cache of file hashes, trusted while the file's size, mtime and inode are unchanged."""
+
+    def __init__(self, path=HASH_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}  # local path -> [size, mtime_ns, inode, md5]
+        self.dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Erro ao carregar o cache de hashes: {e}")
+
+    @staticmethod
+    def stat_signature(file_path):
+        """Return the stat metadata used to detect file changes."""
+        st = os.stat(file_path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, file_path):
+        """Return the cached hash of a file, or None if it changed since it was hashed."""
+        with self.lock:
+            entry = self.entries.get(file_path)
+        if entry and entry[:3] == self.stat_signature(file_path):
+            return entry[3]
+        return None
+
+    def put(self, file_path, file_hash):
+        """Store the hash of a file along with its current stat metadata."""
+        entry = self.stat_signature(file_path) + [file_hash]
+        with self.lock:
+            self.entries[file_path] = entry
+            self.dirty = True
+
+    def prune(self, directory):
+        """Forget the files under directory that no longer exist, e.g. staged files moved into the install."""
+        prefix = os.path.join(directory, "")
+        with self.lock:
+            for file_path in [path for path in self.entries if path.startswith(prefix)]:
+                if not os.path.exists(file_path):
+                    del self.entries[file_path]
+                    self.dirty = True
+
+    def save(self):
+        """Write the cache to disk if it changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+
+class StateStore:
+    """SQLite (WAL) record of downloaded files, committed one entry at a time."""
+
+    def __init__(self, path=STATE_DB_PATH, legacy_path=STATE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        # Autocommit: every upsert is its own atomic transaction
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS downloaded_files ("
+            "path TEXT PRIMARY KEY, hash TEXT NOT NULL, size INTEGER, mtime_ns INTEGER)"
+        )
+        self.migrate_json_state(legacy_path)
+
+    def migrate_json_state(self, legacy_path):
+        """Import the old state.json into the database, once."""
+        if not os.path.exists(legacy_path):
+            return
+
+        try:
+            with open(legacy_path, "r") as f:
+                downloaded_files = json.load(f).get("downloaded_files", {})
+        except (OSError, ValueError) as e:
+            print(f"Erro ao migrar {legacy_path}: {e}")
+            return
+
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO downloaded_files (path, hash) VALUES (?, ?)",
+                downloaded_files.items(),
+            )
+            self.connection.execute("COMMIT")
+        os.replace(legacy_path, legacy_path + ".migrated")
+        print(f"Estado migrado de {legacy_path} ({len(downloaded_files)} arquivos)")
+
+    def all_hashes(self):
+        """Return {path: hash} for every downloaded file."""
+        with self.lock:
+            return dict(self.connection.execute("SELECT path, hash FROM downloaded_files"))
+
+    def all_files(self):
+        """Return {path: (hash, size)} for every downloaded file; size is None for migrated entries."""
+        with self.lock:
+            return {path: (file_hash, size) for path, file_hash, size in
+                    self.connection.execute("SELECT path, hash, size FROM downloaded_files")}
+
+    def get_hash(self, path):
+        """Return the hash recorded for a file, or None."""
+        with self.lock:
+            row = self.connection.execute("SELECT hash FROM downloaded_files WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def set_file(self, path, file_hash, size=None, mtime_ns=None):
+        """Insert or update a downloaded file."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO downloaded_files (path, hash, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                (path, file_hash, size, mtime_ns),
+            )
+
+    def close(self):
+        """Close the database."""
+        with self.lock:
+            self.connection.close()
+
+
+def reflink_file(source, destination):
+    """Clone a file with copy-on-write (Linux FICLONE: Btrfs, XFS, ...). Raises OSError if unsupported."""
+    import fcntl
+
+    ficlone = 0x40049409
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+
+
+_fallocate = None
+
+
+def preallocate_file(fd, offset, length):
+    """Reserve disk space for bytes [offset, offset + length) of an open file without changing its size.
+
+    The filesystem can then lay a big download out in one piece, and a full disk fails before the download
+    instead of in the middle of it. The size is kept so a .part file still tells how much was downloaded.
+    Linux only (fallocate with FALLOC_FL_KEEP_SIZE); returns False where it isn't supported.
+    """
+    global _fallocate
+    if _fallocate is None:
+        _fallocate = False
+        if sys.platform.startswith("linux"):
+            try:
+                import ctypes
+
+                libc = ctypes.CDLL(None, use_errno=True)
+                libc.fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong)
+                libc.fallocate.restype = ctypes.c_int
+                _fallocate = libc.fallocate
+            except (OSError, AttributeError, ImportError):
+                pass
+    if not _fallocate or length <= 0:
+        return False
+
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+        return True
+    import ctypes
+
+    error = ctypes.get_errno()
+    if error == errno.ENOSPC:
+        raise OSError(error, os.strerror(error))
+    return False  # EOPNOTSUPP and friends: the filesystem allocates as it's written
+
+
+def place_file(source, destination, link_mode="auto", allow_hardlink=True):
+    """Create destination with the content of source by reflink, hardlink or copy. Returns the method used."""
+    if link_mode == "auto":
+        methods = ("reflink", "hardlink", "copy")
+    else:
+        methods = (link_mode, "copy") if link_mode != "copy" else ("copy",)
+
+    for method in methods:
+        try:
+            if method == "reflink":
+                reflink_file(source, destination)
+            elif method == "hardlink":
+                if not allow_hardlink:
+                    continue
+                os.link(source, destination)
+            else:
+                shutil.copyfile(source, destination)
+            return method
+        except (OSError, ImportError):
+            if method == "copy":
+                raise
+
+
+class ContentStore:
+    """Verified files kept by MD5 and shared by every install path, evicted least recently used first."""
+
+    def __init__(self, path=CONTENT_STORE_PATH, max_size=CONTENT_STORE_MAX_SIZE, link_mode="auto"):
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.link_mode = link_mode if link_mode in CONTENT_STORE_LINK_MODES else "auto"
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(path, "index.db"), check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # size and mtime_ns detect objects changed in place through a hardlinked install file
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            "md5 TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+
+    @classmethod
+    def from_config(cls, config):
+        """Open the store configured in config.json, or return None if it's disabled."""
+        if not config.get("content_store", True):
+            return None
+        try:
+            return cls(
+                os.path.expanduser(config.get("content_store_path", CONTENT_STORE_PATH)),
+                config.get("content_store_max_size", CONTENT_STORE_MAX_SIZE),
+                config.get("content_store_link", "auto"),
+            )
+        except (OSError, sqlite3.Error) as e:
+            print(f"Erro ao abrir o cache de arquivos: {e}")
+            return None
+
+    def object_path(self, md5):
+        """Return where the object with this MD5 is stored."""
+        return os.path.join(self.path, "objects", md5[:2], md5)
+
+    def lookup(self, md5):
+        """Return the path of a valid object, dropping it if it's missing or was modified."""
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns FROM objects WHERE md5 = ?", (md5,)).fetchone()
+        if row is None:
+            return None
+
+        object_path = self.object_path(md5)
+        try:
+            st = os.stat(object_path)
+            if [st.st_size, st.st_mtime_ns] == list(row):
+                return object_path
+        except OSError:
+            pass
+        self.remove(md5)
+        return None
+
+    def materialize(self, md5, destination, allow_hardlink=True):
+        """Put the object with this MD5 at destination. Returns False if the store doesn't have it."""
+        md5 = md5.lower()
+        object_path = self.lookup(md5)
+        if object_path is None:
+            return False
+
+        tmp_path = destination + ".store"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        place_file(object_path, tmp_path, self.link_mode, allow_hardlink)
+        os.replace(tmp_path, destination)
+        with self.lock:
+            self.connection.execute("UPDATE objects SET last_used = ? WHERE md5 = ?", (time.time(), md5))
+        return True
+
+    def add(self, source, md5, allow_hardlink=True):
+        """Store a verified file under its MD5."""
+        md5 = md5.lower()
+        if self.lookup(md5) is not None:
+            with self.lock:
+                self.connection.execute("UPDATE objects SET last_used = ? WHERE md5 = ?", (time.time(), md5))
+            return
+
+        object_path = self.object_path(md5)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path = f"{object_path}.{threading.get_ident()}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        place_file(source, tmp_path, self.link_mode, allow_hardlink)
+        os.replace(tmp_path, object_path)
+        st = os.stat(object_path)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO objects (md5, size, mtime_ns, last_used) VALUES (?, ?, ?, ?)",
+                (md5, st.st_size, st.st_mtime_ns, time.time()),
+            )
+        self.evict()
+
+    def can_link(self, path):
+        """Return True if files under path can enter the store without a full copy (same filesystem)."""
+        if self.link_mode == "copy":
+            return False
+        try:
+            return os.stat(path).st_dev == os.stat(self.path).st_dev
+        except OSError:
+            return False
+
+    def known_hashes(self):
+        """Return the set of MD5s in the store."""
+        with self.lock:
+            return {row[0] for row in self.connection.execute("SELECT md5 FROM objects")}
+
+    def remove(self, md5):
+        """Delete an object."""
+        with self.lock:
+            self.connection.execute("DELETE FROM objects WHERE md5 = ?", (md5,))
+        try:
+            os.remove(self.object_path(md5))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Delete the least recently used objects until the store fits in max_size."""
+        with self.lock:
+            total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            if total <= self.max_size:
+                return
+            victims = []
+            for md5, size in self.connection.execute("SELECT md5, size FROM objects ORDER BY last_used"):
+                if total <= self.max_size:
+                    break
+                victims.append(md5)
+                total -= size
+        for md5 in victims:
+            self.remove(md5)
+
+    def close(self):
+        """Close the index."""
+        with self.lock:
+            self.connection.close()
+
+
+class DiskWriter:
+    """How downloads reach the disk: read size, write buffer, preallocation, buffer reuse and fsync policy.
+
+    The fsync policy trades durability for speed. "none" leaves flushing to the OS, so a power cut right after
+    a patch may leave files empty or truncated (the next patch finds and fixes them). "commit" syncs the
+    staged files once, before the commit moves them into the install. "always" also syncs every file as soon
+    as it's downloaded, so resumed downloads never start from data that didn't reach the disk.
+    """
+
+    def __init__(self, chunk_size=DOWNLOAD_CHUNK_SIZE, buffer_size=WRITE_BUFFER_SIZE, preallocate=True,
+                 fsync="commit", buffer_pool=False):
+        self.chunk_size = max(4096, int(chunk_size))
+        self.buffer_size = max(WRITE_BUFFER_MIN_SIZE, int(buffer_size))
+        self.preallocate = preallocate
+        self.fsync = fsync if fsync in FSYNC_POLICIES else "commit"
+        # Read buffers reused by the download threads; None reads each chunk into a new bytes object
+        self.buffers = [] if buffer_pool else None
+        self.buffers_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create the writer configured in config.json (sizes in KB)."""
+        return cls(
+            config.get("download_chunk_size", DOWNLOAD_CHUNK_SIZE // 1024) * 1024,
+            config.get("write_buffer_size", WRITE_BUFFER_SIZE // 1024) * 1024,
+            config.get("preallocate", True),
+            config.get("fsync", "commit"),
+            config.get("download_buffer_pool", False),
+        )
+
+    def open(self, path, offset=0, size=0):
+        """Open a download for writing, appending from offset, with disk space reserved for size bytes."""
+        f = open(path, "ab" if offset else "wb", buffering=self.buffer_size)
+        if self.preallocate and size - offset >= PREALLOCATE_MIN_SIZE:
+            try:
+                preallocate_file(f.fileno(), offset, size - offset)
+            except OSError:
+                f.close()
+                raise
+        return f
+
+    def chunks(self, response, encoded=False):
+        """Iterate over the body of a streamed response, chunk_size bytes at a time.
+
+        With the buffer pool an identity body is read with readinto into a reused buffer; every chunk is then
+        a memoryview that is only valid until the next one is read.
+        """
+        if self.buffers is None or encoded:
+            yield from response.iter_content(chunk_size=self.chunk_size)
+            return
+
+        with self.buffers_lock:
+            buffer = self.buffers.pop() if self.buffers else bytearray(self.chunk_size)
+        try:
+            view = memoryview(buffer)
+            while True:
+                size = response.raw.readinto(view)
+                if not size:
+                    return
+                yield view[:size]
+        finally:
+            with self.buffers_lock:
+                self.buffers.append(buffer)
+
+    def finish(self, f):
+        """Flush a completely written download, syncing it to disk under the "always" policy."""
+        f.flush()
+        if self.fsync == "always":
+            os.fsync(f.fileno())
+
+    def sync(self, paths, data=True):
+        """Sync files, and the directories listing them, before a commit relies on them being on disk.
+
+        With data=False only the directories are synced, making renames into them durable.
+        """
+        if self.fsync == "none":
+            return
+        directories = set()
+        for path in paths:
+            if data and os.path.exists(path):
+                with open(path, "rb") as f:
+                    os.fsync(f.fileno())
+            directories.add(os.path.dirname(path))
+        if not hasattr(os, "O_DIRECTORY"):
+            return  # Windows can't open directories; NTFS journals the renames itself
+        for directory in directories:
+            if os.path.isdir(directory):
+                fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+
+class ProgressAggregator:
+    """Coalesce byte counts from the download threads and report them at a fixed rate."""
+
+    def __init__(self, callback, interval=PROGRESS_UPDATE_INTERVAL, window=SPEED_WINDOW):
+        self.callback = callback  # callback(file_bytes, file_total, total_bytes, bytes_per_second)
+        self.interval = interval
+        self.window = window
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.last_file = (0, 0)
+        self.last_report = 0.0
+        self.samples = deque()  # (time, total_bytes) within the speed window
+
+    def add(self, nbytes, file_bytes, file_total):
+        """Count downloaded bytes, reporting them if the update interval has passed."""
+        with self.lock:
+            self.total_bytes += nbytes
+            self.last_file = (file_bytes, file_total)
+            now = time.monotonic()
+            if now - self.last_report < self.interval:
+                return
+            report = self.snapshot(now)
+        self.callback(*report)
+
+    def flush(self):
+        """Report the current totals immediately."""
+        with self.lock:
+            report = self.snapshot(time.monotonic())
+        self.callback(*report)
+
+    def snapshot(self, now):
+        """Record a speed sample and return the values to report. Must hold the lock."""
+        self.last_report = now
+        self.samples.append((now, self.total_bytes))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+
+        oldest_time, oldest_bytes = self.samples[0]
+        elapsed = now - oldest_time
+        bytes_per_second = (self.total_bytes - oldest_bytes) / elapsed if elapsed > 0 else 0.0
+        return self.last_file[0], self.last_file[1], self.total_bytes, bytes_per_second
+
+
+class Telemetry:
+    """Record a patch run as a Chrome trace (chrome://tracing, Perfetto) with counters and latency histograms."""
+
+    HISTOGRAM_BUCKETS_MS = tuple(2 ** i for i in range(17))  # 1 ms .. 65 s
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self.thread_names = {}  # tid -> thread name
+        self.phases = defaultdict(lambda: [0, 0.0])  # span name -> [count, total seconds]
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(list)  # name -> durations in seconds
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Time a block as a trace span. The yielded dict is stored as the span's args."""
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add_span(name, start, time.perf_counter(), args)
+
+    def add_span(self, name, start, end, args=None):
+        """Record a span between two perf_counter() times."""
+        thread = threading.current_thread()
+        event = {
+            "name": name, "ph": "X", "pid": self.pid, "tid": thread.ident,
+            "ts": round((start - self.started) * 1e6), "dur": round((end - start) * 1e6),
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            self.events.append(event)
+            self.thread_names.setdefault(thread.ident, thread.name)
+            phase = self.phases[name]
+            phase[0] += 1
+            phase[1] += end - start
+
+    def count(self, name, value=1):
+        """Add to a counter."""
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        """Add a duration to a latency histogram."""
+        with self.lock:
+            self.histograms[name].append(seconds)
+
+    def summary(self):
+        """Return the per-phase totals, counters and histogram statistics."""
+        with self.lock:
+            histograms = {}
+            for name, values in self.histograms.items():
+                values = sorted(values)
+                buckets = {}
+                for value in values:
+                    bound = next((b for b in self.HISTOGRAM_BUCKETS_MS if value * 1000 <= b), None)
+                    label = f"<={bound}ms" if bound else f">{self.HISTOGRAM_BUCKETS_MS[-1]}ms"
+                    buckets[label] = buckets.get(label, 0) + 1
+                histograms[name] = {
+                    "count": len(values),
+                    "min_ms": round(values[0] * 1000, 3),
+                    "p50_ms": round(values[len(values) // 2] * 1000, 3),
+                    "p90_ms": round(values[int(len(values) * 0.9)] * 1000, 3),
+                    "p99_ms": round(values[int(len(values) * 0.99)] * 1000, 3),
+                    "max_ms": round(values[-1] * 1000, 3),
+                    "buckets": buckets,
+                }
+            return {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.wall_started)),
+                "elapsed": round(time.perf_counter() - self.started, 3),
+                "phases": {name: {"count": count, "seconds": round(total, 3)} for name, (count, total) in self.phases.items()},
+                "counters": dict(self.counters),
+                "histograms": histograms,
+            }
+
+    def save(self, directory=TRACE_DIR, keep=TRACE_KEEP):
+        """Write the trace to directory, keeping only the newest files. Returns its path."""
+        summary = self.summary()
+        with self.lock:
+            metadata = [
+                {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self.thread_names.items()
+            ]
+            trace = {"traceEvents": metadata + self.events, "displayTimeUnit": "ms", "otherData": summary}
+
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.wall_started))
+        path = os.path.join(directory, f"patch-{stamp}-{self.pid}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(trace, f)
+        os.replace(tmp_path, path)
+
+        traces = sorted(name for name in os.listdir(directory) if name.startswith("patch-") and name.endswith(".json"))
+        for name in traces[:-keep]:
+            os.remove(os.path.join(directory, name))
+        return path
+
+
+class RateLimiter:
+    """Token bucket shared by every download thread. The rate can be changed while downloading."""
+
+    def __init__(self, bytes_per_second=0):
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(bytes_per_second)
+
+    def set_rate(self, bytes_per_second):
+        """Change the limit, in bytes per second (0 = unlimited)."""
+        with self.lock:
+            self.rate = max(0, bytes_per_second)
+            self.capacity = max(self.rate * RATE_LIMIT_BURST, 64 * 1024)
+            self.tokens = min(self.tokens, self.capacity)
+            self.updated = time.monotonic()
+
+    def consume(self, nbytes, stop=None):
+        """Wait until nbytes may be downloaded, or until stop() is true."""
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # Chunks bigger than the bucket go through once it is full and leave it in debt
+                if self.tokens >= min(nbytes, self.capacity):
+                    self.tokens -= nbytes
+                    return
+                wait = (min(nbytes, self.capacity) - self.tokens) / self.rate
+            if stop is not None and stop():
+                return
+            # Sleep in short steps so a new rate takes effect right away
+            time.sleep(min(wait, 0.1))
+
+
+class DownloadQueue:
+    """Pending downloads, client files first and then smallest first. Sizes may arrive while downloading."""
+
+    def __init__(self, entries):
+        self.lock = threading.Lock()
+        self.heap = []  # (priority, size, order, entry); an entry may be queued again with a better size
+        self.taken = set()
+        self.order = {}
+        for order, entry in enumerate(entries):
+            self.order[entry] = order
+            size = os.path.getsize(entry.local_path) if os.path.exists(entry.local_path) else UNKNOWN_FILE_SIZE
+            self.heap.append((self.priority(entry), size, order, entry))
+        heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.order)
+
+    @staticmethod
+    def priority(entry):
+        """0 for the client itself, 1 for the data files in Data/, 2 for everything else."""
+        path = entry.remote_path
+        if path.startswith(CLIENT_DATA_DIR):
+            return 1 if "/" not in path[len(CLIENT_DATA_DIR):] else 2
+        return 0 if path.startswith(CLIENT_DIR) else 2
+
+    def set_size(self, entry, size):
+        """Reschedule an entry with its real download size."""
+        with self.lock:
+            if entry not in self.taken:
+                heapq.heappush(self.heap, (self.priority(entry), size, self.order[entry], entry))
+
+    def pop(self):
+        """Return the next entry to download, or None when the queue is empty."""
+        with self.lock:
+            while self.heap:
+                entry = heapq.heappop(self.heap)[3]
+                if entry not in self.taken:
+                    self.taken.add(entry)
+                    return entry
+        return None
+
+
+class ManifestEntry:
+    """A file listed in the Manifest, with its paths, flags and expected hash resolved once."""
+
+    __slots__ = ("manifest_path", "remote_path", "local_path", "if_missing", "expected_hash", "compression")
+
+    def __init__(self, manifest_path, remote_path, local_path, if_missing, expected_hash, compression=""):
+        self.manifest_path = manifest_path  # Path as written in the Manifest, used as key in Hashes
+        self.remote_path = remote_path  # Path on the server and in the state store, without the "+" flag
+        self.local_path = local_path  # Absolute path inside the install
+        self.if_missing = if_missing  # "+" flag: only downloaded when the file doesn't exist locally
+        self.expected_hash = expected_hash  # Hash from Hashes, "" if it isn't listed
+        self.compression = compression  # Format of the compressed sidecar on the server ("zst", "gz"), "" if none
+
+    def as_tuple(self):
+        """Return the entry as a plain tuple, for caching."""
+        return (self.manifest_path, self.remote_path, self.local_path, self.if_missing, self.expected_hash,
+                self.compression)
+
+
+class Manifest:
+    """Index of the Manifest and Hashes files, each streamed once, cached between runs."""
+
+    def __init__(self, entries):
+        self.entries = entries  # manifest path -> ManifestEntry, in Manifest order
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, manifest_path):
+        """Return the entry for a Manifest path, or None."""
+        return self.entries.get(manifest_path)
+
+    @classmethod
+    def load(cls, manifest_path, hashes_path, install_path, cache_path=MANIFEST_CACHE_PATH):
+        """Load the index, reusing the cached parse while both files are unchanged."""
+        signature = [MANIFEST_CACHE_VERSION, install_path]
+        for path in (manifest_path, hashes_path):
+            st = os.stat(path)
+            signature += [st.st_size, st.st_mtime_ns]
+
+        try:
+            with open(cache_path, "rb") as f:
+                cached_signature, rows = pickle.load(f)
+            if cached_signature == signature:
+                return cls({row[0]: ManifestEntry(*row) for row in rows})
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            pass
+
+        manifest = cls.parse(manifest_path, hashes_path, install_path)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump((signature, [entry.as_tuple() for entry in manifest]), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Erro ao salvar o cache do Manifest: {e}")
+        return manifest
+
+    @classmethod
+    def parse(cls, manifest_path, hashes_path, install_path):
+        """Stream the Hashes and Manifest files and build the index."""
+        hashes = {}  # manifest path -> (md5, sidecar format)
+        with open(hashes_path, "r", encoding='utf-8-sig') as f:
+            for line in f:
+                parts = line.strip().split('\t')
+                if len(parts) >= 2:
+                    # The sidecar format is whichever extra column names one; other columns are left alone
+                    compression = next((p.strip() for p in parts[2:] if p.strip() in compress.SIDECAR_SUFFIXES), "")
+                    hashes[parts[0].strip()] = (parts[1].strip(), compression)
+
+        entries = {}
+        with open(manifest_path, "r") as f:
+            for line in f:
+                file_path = line.strip()
+                if not file_path.startswith('/') or file_path.startswith('/-'):
+                    continue
+
+                dir_path, file_name = os.path.split(file_path)
+                if_missing = file_name.startswith('+')
+                remote_path = os.path.join(dir_path, file_name[1:]) if if_missing else file_path
+                local_path = os.path.join(install_path, remote_path.lstrip('/'))
+                expected_hash, compression = hashes.get(file_path, ("", ""))
+                entries[file_path] = ManifestEntry(file_path, remote_path, local_path, if_missing, expected_hash, compression)
+        return cls(entries)
+
+
+class Staging:
+    """A patch downloaded into the install's staging directory and committed with a journal.
+
+    Every patch goes through here: files are verified in the staging directory and only then moved into the
+    install. The commit is written to a journal first, so a crash halfway through can be rolled forward
+    (or back, if the staged files are gone) on the next run.
+    """
+
+    def __init__(self, install_path):
+        self.install_path = install_path
+        self.root = os.path.join(install_path, STAGING_DIR_NAME)
+        self.manifest_path = os.path.join(self.root, "Manifest")
+        self.hashes_path = os.path.join(self.root, "Hashes")
+        self.state_path = os.path.join(self.root, "staging.json")
+        self.journal_path = os.path.join(self.root, "journal.json")
+        self.lock = threading.Lock()
+        # files: remote path -> [md5, "+" flag]; complete: every pending file of this Hashes is staged;
+        # sync_state: validators of the staged Manifest/Hashes
+        self.state = {"files": {}, "complete": False, "sync_state": {}}
+        if os.path.exists(self.state_path):
+            try:
+                with open(self.state_path, "r") as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Erro ao carregar o patch preparado: {e}")
+
+    def has_index(self):
+        """Return True if a Manifest and Hashes are staged."""
+        return os.path.exists(self.manifest_path) and os.path.exists(self.hashes_path)
+
+    def stage_index(self, new_paths, current_paths, validators):
+        """Move freshly synced Manifest/Hashes (.new files, or None if unchanged) into the staging directory."""
+        os.makedirs(self.root, exist_ok=True)
+        for new_path, current_path, staged_path in zip(new_paths, current_paths, (self.manifest_path, self.hashes_path)):
+            if new_path is not None:
+                os.replace(new_path, staged_path)
+            elif current_path != staged_path:
+                shutil.copyfile(current_path, staged_path)
+        self.state["sync_state"] = validators
+        self.state["complete"] = False
+
+    def unstage_index(self):
+        """Drop a staged Manifest/Hashes that the install already has."""
+        for path in (self.manifest_path, self.hashes_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.state["sync_state"] = {}
+
+    def path_for(self, entry):
+        """Return where the new version of an entry is staged."""
+        return self.file_path(entry.remote_path)
+
+    def file_path(self, remote_path):
+        """Return where the new version of a file is staged."""
+        return os.path.join(self.root, "files", remote_path.lstrip('/'))
+
+    def backup_path(self, remote_path):
+        """Return where the replaced version of a file is kept while a commit runs."""
+        return os.path.join(self.root, "backup", remote_path.lstrip('/'))
+
+    def record(self, entry, file_hash):
+        """Remember a verified staged file."""
+        with self.lock:
+            self.state["files"][entry.remote_path] = [file_hash, entry.if_missing]
+
+    def keep_only(self, pending_files):
+        """Drop the staged files that the pending entries don't need anymore, e.g. from an older patch."""
+        pending_hashes = {entry.remote_path: entry.expected_hash.lower() for entry in pending_files}
+        for remote_path, (file_hash, _) in list(self.state["files"].items()):
+            if pending_hashes.get(remote_path) != file_hash:
+                with self.lock:
+                    self.state["files"].pop(remote_path, None)
+                path = self.file_path(remote_path)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def save(self):
+        """Write the staging state."""
+        os.makedirs(self.root, exist_ok=True)
+        with self.lock:
+            tmp_path = self.state_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.state_path)
+
+    def load_journal(self):
+        """Return the commit journal, or None if no commit was interrupted."""
+        try:
+            with open(self.journal_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            # Written atomically, so an unreadable journal means the commit never started
+            print(f"Erro ao ler o diário do patch, descartando: {e}")
+            return None
+
+    def write_journal(self, journal):
+        """Write the commit journal and make sure it's on disk before any file is moved."""
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.root, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def moves(self, journal):
+        """Return (staged, live, backup, existed, remote path, md5) for every file in a commit journal."""
+        moves = []
+        for remote_path, file_hash, existed in journal["files"]:
+            moves.append((self.file_path(remote_path), os.path.join(self.install_path, remote_path.lstrip('/')),
+                          self.backup_path(remote_path), existed, remote_path, file_hash))
+        for name, existed in journal["index"]:
+            moves.append((os.path.join(self.root, name), os.path.join(self.install_path, name),
+                          self.backup_path(name), existed, None, None))
+        return moves
+
+    def clear(self, keep_parts=False):
+        """Delete the staging directory.
+
+        With keep_parts the partial downloads (.part and .part.json) stay, so the files that failed in a
+        patch committed without them resume on the next run instead of starting over.
+        """
+        self.state = {"files": {}, "complete": False, "sync_state": {}}
+        files_root = os.path.join(self.root, "files")
+        if not keep_parts or not os.path.isdir(files_root):
+            shutil.rmtree(self.root, ignore_errors=True)
+            return
+
+        for name in os.listdir(self.root):
+            if name != "files":
+                path = os.path.join(self.root, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+        for directory, _, file_names in os.walk(files_root, topdown=False):
+            for file_name in file_names:
+                if not file_name.endswith((".part", ".part.json")):
+                    os.remove(os.path.join(directory, file_name))
+            if not os.listdir(directory):
+                os.rmdir(directory)
+        if not os.path.exists(files_root):
+            os.rmdir(self.root)
+
+
+def _ignore(*args):
+    """Default for the Patcher callbacks that nobody listens to."""
+
+
+class Patcher:
+    """Manifest/Hashes sync, verification and download pipeline, without any GUI."""
+
+    def __init__(self, install_path, state_store, stop_download, max_workers=DEFAULT_DOWNLOAD_WORKERS,
+                 deep_verify=False, base_url=None, delta_patching=True, rate_limiter=None, content_store=None,
+                 peers=(), peer_discovery=False, mirrors=(), writer=None, on_status=_ignore, on_hashing=_ignore,
+                 on_file_progress=_ignore, on_files_completed=_ignore, on_total_size=_ignore, on_speed=_ignore):
+        self.install_path = install_path
+        self.state_store = state_store
+        self.stop_download = stop_download
+        self.base_url = base_url or f"http://{SERVER_HOSTNAME}:{SERVER_PORT}"
+        # Callbacks, called from the patch threads
+        self.on_status = on_status  # on_status(message)
+        self.on_hashing = on_hashing  # on_hashing(message)
+        self.on_file_progress = on_file_progress  # on_file_progress(file_bytes, file_total)
+        self.on_files_completed = on_files_completed  # on_files_completed(completed, total)
+        self.on_total_size = on_total_size  # on_total_size(total_bytes)
+        self.on_speed = on_speed  # on_speed(total_downloaded_bytes, bytes_per_second)
+        self.max_workers = max(1, int(max_workers))
+        self.deep_verify = deep_verify  # Ignore the hash cache and rehash every file
+        self.delta_patching = delta_patching  # Update large files by fetching only their changed blocks
+        self.rate_limiter = rate_limiter or RateLimiter()  # Shared with the caller so it can change the rate
+        self.content_store = content_store  # ContentStore shared with the other installs, or None
+        # LAN launchers to download from ("host:port"); each is only used if its Hashes matches the server's
+        self.peer_candidates = [p if "://" in p else f"http://{p}" for p in peers]
+        self.peer_discovery = peer_discovery
+        self.peers = []  # Base URLs of the peers in use for this run
+        self.peers_lock = threading.Lock()
+        # Other patch servers with the same files ("host:port"); base_url is always the best one known
+        self.mirrors = [m if "://" in m else f"http://{m}" for m in mirrors]
+        self.servers = []  # base_url and the mirrors, fastest first, set by run()
+        self.servers_lock = threading.Lock()
+        self.staging = None  # Staging that downloads go to instead of the install, set by prefetch()
+        self.writer = writer or DiskWriter()  # How downloads are written and synced to disk
+        self.hash_cache = HashCache()
+        self.telemetry = Telemetry()  # Replaced at the start of every run()
+        self.trace_path = None  # Trace file of the last run
+        self.progress = ProgressAggregator(self.report_progress)
+        # One connection per download and HEAD thread, plus one for Manifest/Hashes
+        self.session = get_http_session(pool_size=max(HTTP_POOL_SIZE, self.max_workers + HEAD_WORKERS + 1))
+
+    def run(self):
+        """Sync, verify and download the install. Returns (success, failed_files)."""
+        self.telemetry = Telemetry()
+        try:
+            with install_lock(self.install_path, stop=self.stop_download,
+                              on_wait=lambda: self.on_status("Aguardando o patch em segundo plano...")) as locked:
+                if not locked:
+                    return False, []  # Stopped while waiting
+                with self.telemetry.span("run", install_path=self.install_path, deep_verify=self.deep_verify):
+                    return self.run_phases()
+        finally:
+            self.staging = None
+            with self.telemetry.span("save_hash_cache"):
+                self.save_hash_cache()
+            self.save_trace()
+
+    def prefetch(self):
+        """Download the server's next patch into the staging directory, leaving the install untouched.
+
+        Returns (staged, failed_files); staged is True when the whole patch is ready for apply_staged().
+        Returns (False, []) right away if another patch holds the install.
+        """
+        self.telemetry = Telemetry()
+        try:
+            with install_lock(self.install_path, blocking=False) as locked:
+                if not locked:
+                    print("Outro patch está em andamento nesta instalação")
+                    return False, []
+                with self.telemetry.span("prefetch", install_path=self.install_path):
+                    return self.prefetch_phases()
+        finally:
+            self.staging = None
+            with self.telemetry.span("save_hash_cache"):
+                self.save_hash_cache()
+            self.save_trace()
+
+    def run_phases(self):
+        """The steps of run(), each timed as a trace span."""
+        manifest_path = os.path.join(self.install_path, "Manifest")
+        hashes_path = os.path.join(self.install_path, "Hashes")
+
+        # Finish (or undo) a commit cut short by a crash, then move in a patch prefetched in the background;
+        # the sync below then finds nothing new. While the game runs it stays staged: the sync below reuses
+        # its verified files and the patch goes in through its own commit
+        self.recover_staged()
+        if not game_running(self.install_path):
+            self.apply_staged()
+
+        # Look for LAN peers while Manifest/Hashes download
+        discovered_peers = []
+        discovery = None
+        if self.peer_discovery:
+            # Imported here: peer pulls in http.server, which the launcher window shouldn't wait for
+            import peer
+
+            discovery = threading.Thread(target=lambda: discovered_peers.extend(peer.discover_peers()), daemon=True)
+            discovery.start()
+
+        sync_state = self.load_sync_state()
+        # The last synced Manifest/Hashes can only be trusted if that patch finished cleanly
+        previous_complete = sync_state.get("complete", False) and not self.deep_verify
+
+        self.select_servers()
+        # The new validators only reach sync_state when the patch is committed
+        validators = {name: dict(sync_state.get(name, {})) for name in ("Manifest", "Hashes")}
+        new_manifest_path, new_hashes_path = self.sync_index_files(manifest_path, hashes_path, validators)
+
+        if previous_complete and new_manifest_path is None and new_hashes_path is None:
+            print("Manifest e Hashes não mudaram desde o último patch.")
+            self.on_status("Arquivos já estão atualizados")
+            return True, []
+
+        staging = Staging(self.install_path)
+        with self.telemetry.span("manifest_load") as span:
+            old_manifest = None
+            if previous_complete:
+                old_manifest = Manifest.load(manifest_path, hashes_path, self.install_path)
+
+            if new_manifest_path is not None or new_hashes_path is not None:
+                staging.stage_index((new_manifest_path, new_hashes_path), (manifest_path, hashes_path), validators)
+                manifest_path, hashes_path = staging.manifest_path, staging.hashes_path
+            else:
+                staging.unstage_index()
+            manifest = Manifest.load(manifest_path, hashes_path, self.install_path)
+            span["files"] = len(manifest)
+
+        with self.telemetry.span("plan") as span:
+            pending_files = self.plan_update(manifest, old_manifest)
+            staging.keep_only(pending_files)
+            span["pending_files"] = len(pending_files)
+
+        if discovery is not None:
+            discovery.join()
+        if pending_files and (self.peer_candidates or discovered_peers):
+            with self.telemetry.span("peer_select") as span:
+                self.peers = self.select_peers(hashes_path, self.peer_candidates + discovered_peers)
+                span["peers"] = self.peers
+
+        # Sum the size of the pending files in the background so downloads start right away;
+        # the sizes also reorder the queue, probed in priority order so the client is sized first
+        queue = DownloadQueue(pending_files)
+        threading.Thread(
+            target=self.calculate_total_download_size,
+            args=(sorted(pending_files, key=DownloadQueue.priority), queue.set_size), daemon=True,
+        ).start()
+
+        self.staging = staging
+        with self.telemetry.span("download", files=len(pending_files)):
+            failed_files = self.download_pending_files(queue)
+            self.progress.flush()
+        self.staging = None
+
+        if self.stop_download():
+            # The install is untouched; the verified downloads wait in the staging directory for the next run
+            staging.save()
+            return False, failed_files
+
+        # Files that failed keep their old version, as before; the next patch retries them
+        self.commit_staged(staging, complete=not failed_files)
+        if not failed_files:
+            self.seed_content_store(manifest)
+        return True, failed_files
+
+    def scan(self, on_issue=_ignore):
+        """Check the install against its Manifest without downloading anything. Returns a report dict.
+
+        Missing files and files whose size differs from the one recorded when they were downloaded are
+        reported through on_issue(kind, path) right away, from a single directory walk. The other files are
+        then hashed in the background, most recently modified first, as those are the likeliest to have
+        changed; deep_verify ignores the hash cache. Files that aren't in the Manifest are reported as "extra".
+        """
+        self.telemetry = Telemetry()
+        try:
+            with install_lock(self.install_path, stop=self.stop_download,
+                              on_wait=lambda: self.on_status("Aguardando o patch em segundo plano...")) as locked:
+                if not locked:
+                    return None
+                with self.telemetry.span("scan", install_path=self.install_path, deep_verify=self.deep_verify):
+                    return self.scan_phases(on_issue)
+        finally:
+            with self.telemetry.span("save_hash_cache"):
+                self.save_hash_cache()
+            self.save_trace()
+
+    def scan_phases(self, on_issue):
+        """The steps of scan(), each timed as a trace span."""
+        manifest_path = os.path.join(self.install_path, "Manifest")
+        hashes_path = os.path.join(self.install_path, "Hashes")
+        if not os.path.exists(manifest_path) or not os.path.exists(hashes_path):
+            raise Exception("A instalação não tem Manifest/Hashes, faça o patch primeiro")
+
+        report = {"files": 0, "ok": 0, "missing": [], "wrong_size": [], "corrupt": [], "extra": [], "unreadable": []}
+
+        def issue(kind, path):
+            report[kind].append(path)
+            on_issue(kind, path)
+
+        with self.telemetry.span("manifest_load"):
+            manifest = Manifest.load(manifest_path, hashes_path, self.install_path)
+        with self.telemetry.span("scan_walk") as span:
+            self.on_status("Listando os arquivos...")
+            found = walk_files(self.install_path, skip={f"/{STAGING_DIR_NAME}"})
+            span["files"] = len(found)
+
+        # Triage: existence and size need no reads at all
+        recorded = self.state_store.all_files()
+        to_hash = []  # (mtime, entry)
+        for entry in manifest:
+            report["files"] += 1
+            st = found.pop(entry.remote_path, None)
+            if st is None:
+                issue("missing", entry.manifest_path)
+            elif entry.if_missing:
+                report["ok"] += 1  # The player's own config, any content is fine
+            elif not entry.expected_hash:
+                report["ok"] += 1  # Not in Hashes, nothing to compare with
+            else:
+                recorded_hash, recorded_size = recorded.get(entry.remote_path, (None, None))
+                if (recorded_size is not None and recorded_hash.lower() == entry.expected_hash.lower()
+                        and recorded_size != st.st_size):
+                    issue("wrong_size", entry.manifest_path)
+                else:
+                    to_hash.append((st.st_mtime_ns, entry))
+
+        for relative_path in sorted(found):
+            if relative_path not in ("/Manifest", "/Hashes"):
+                issue("extra", relative_path)
+
+        to_hash.sort(key=lambda item: item[0], reverse=True)
+        with self.telemetry.span("scan_hash", files=len(to_hash)), \
+                ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            def work(entry):
+                if self.stop_download():
+                    return entry, None
+                try:
+                    return entry, self.hash_file(entry.local_path, entry.manifest_path)
+                except OSError as e:
+                    print(f"Erro ao calcular o hash de {entry.manifest_path}: {e}")
+                    return entry, e
+
+            # The pool takes the files in submission order, newest first
+            futures = [executor.submit(work, entry) for _, entry in to_hash]
+            for future in as_completed(futures):
+                entry, result = future.result()
+                if result is None:
+                    continue  # Stopped
+                if isinstance(result, OSError):
+                    issue("unreadable", entry.manifest_path)
+                elif result.lower() != entry.expected_hash.lower():
+                    issue("corrupt", entry.manifest_path)
+                else:
+                    report["ok"] += 1
+                if self.stop_download():
+                    for pending in futures:
+                        pending.cancel()
+
+        if report["missing"] or report["wrong_size"] or report["corrupt"] or report["unreadable"]:
+            # The next patch must look at every file instead of trusting the last complete one
+            sync_state = self.load_sync_state()
+            sync_state["complete"] = False
+            self.save_sync_state(sync_state)
+        report["interrupted"] = self.stop_download()
+        return report
+
+    def prefetch_phases(self):
+        """The steps of prefetch(), each timed as a trace span."""
+        manifest_path = os.path.join(self.install_path, "Manifest")
+        hashes_path = os.path.join(self.install_path, "Hashes")
+        self.recover_staged()
+        sync_state = self.load_sync_state()
+        if not sync_state.get("complete", False) or not os.path.exists(manifest_path):
+            # Without a complete install to compare against there's nothing safe to stage
+            print("A instalação não está completa, o patch precisa ser feito pelo launcher")
+            return False, []
+
+        staging = Staging(self.install_path)
+        self.select_servers()
+        if staging.has_index():
+            index_paths = (staging.manifest_path, staging.hashes_path)
+            validators = staging.state["sync_state"]
+        else:
+            # Poll against the install's own Manifest/Hashes, without touching its validators
+            index_paths = (manifest_path, hashes_path)
+            validators = {name: dict(sync_state.get(name, {})) for name in ("Manifest", "Hashes")}
+        new_manifest_path, new_hashes_path = self.sync_index_files(*index_paths, validators)
+
+        if new_manifest_path is None and new_hashes_path is None:
+            if not staging.has_index() or staging.state["complete"]:
+                print("Nenhum patch novo no servidor.")
+                return staging.state["complete"], []
+        else:
+            staging.stage_index((new_manifest_path, new_hashes_path), index_paths, validators)
+            print("Patch novo encontrado no servidor, baixando em segundo plano.")
+
+        with self.telemetry.span("manifest_load") as span:
+            old_manifest = Manifest.load(manifest_path, hashes_path, self.install_path)
+            # Parsed without the cache, which belongs to the install's Manifest
+            manifest = Manifest.parse(staging.manifest_path, staging.hashes_path, self.install_path)
+            span["files"] = len(manifest)
+
+        with self.telemetry.span("plan") as span:
+            pending_files = self.plan_update(manifest, old_manifest)
+            staging.keep_only(pending_files)
+            span["pending_files"] = len(pending_files)
+
+        self.staging = staging
+        queue = DownloadQueue(pending_files)
+        threading.Thread(
+            target=self.calculate_total_download_size,
+            args=(sorted(pending_files, key=DownloadQueue.priority), queue.set_size), daemon=True,
+        ).start()
+        with self.telemetry.span("download", files=len(pending_files)):
+            failed_files = self.download_pending_files(queue)
+            self.progress.flush()
+
+        staging.state["complete"] = not self.stop_download() and not failed_files
+        staging.save()
+        if staging.state["complete"]:
+            print(f"Patch preparado: {len(staging.state['files'])} arquivos prontos para aplicar.")
+        return staging.state["complete"], failed_files
+
+    def apply_staged(self):
+        """Commit a completely prefetched patch into the install. Returns True if one was applied.
+
+        The caller must hold the install lock and make sure the game isn't running.
+        """
+        self.recover_staged()
+        staging = Staging(self.install_path)
+        if not staging.state["complete"] or not staging.has_index():
+            return False
+
+        self.on_status("Aplicando o patch baixado em segundo plano...")
+        self.commit_staged(staging)
+        return True
+
+    def commit_staged(self, staging, complete=True):
+        """Move the staged files and Manifest/Hashes into the install as one journaled transaction.
+
+        complete is saved in sync_state: False when some files of the patch failed and kept their old version.
+        """
+        files = []
+        for remote_path, (file_hash, if_missing) in staging.state["files"].items():
+            local_path = os.path.join(self.install_path, remote_path.lstrip('/'))
+            if not os.path.exists(staging.file_path(remote_path)) or (if_missing and os.path.exists(local_path)):
+                continue  # Recorded but gone, or a "+" file the player created meanwhile; the next patch sees to it
+            files.append([remote_path, file_hash, os.path.exists(local_path)])
+        index = []
+        if staging.has_index():
+            index = [[name, os.path.exists(os.path.join(self.install_path, name))] for name in ("Manifest", "Hashes")]
+
+        journal = {"files": files, "index": index, "sync_state": staging.state["sync_state"], "complete": complete}
+        with self.telemetry.span("commit", files=len(files)):
+            os.makedirs(staging.root, exist_ok=True)
+            # The journal promises the staged files can be moved in, so they must reach the disk before it
+            with self.telemetry.span("fsync", files=len(files), policy=self.writer.fsync):
+                staged_paths = [staging.file_path(remote_path) for remote_path, _, _ in files]
+                if index:
+                    staged_paths += [staging.manifest_path, staging.hashes_path]
+                self.writer.sync(staged_paths)
+            staging.write_journal(journal)
+            self.roll_forward(staging, journal)
+        if files:
+            print(f"Patch aplicado: {len(files)} arquivos.")
+
+    def recover_staged(self):
+        """Finish a commit interrupted by a crash, or undo it if the staged files needed to finish are gone."""
+        staging = Staging(self.install_path)
+        journal = staging.load_journal()
+        if journal is None:
+            return
+
+        with self.telemetry.span("recover", files=len(journal["files"])) as span:
+            # A file is done once its staged copy was renamed over the live one, which is backed up first
+            can_roll_forward = all(
+                os.path.exists(staged) or (os.path.exists(live) and (os.path.exists(backup) or not existed))
+                for staged, live, backup, existed, _, _ in staging.moves(journal)
+            )
+            if can_roll_forward:
+                print("Concluindo o patch interrompido...")
+                span["action"] = "roll_forward"
+                self.roll_forward(staging, journal)
+            else:
+                print("Desfazendo o patch interrompido...")
+                span["action"] = "roll_back"
+                self.roll_back(staging, journal)
+
+    def roll_forward(self, staging, journal):
+        """Apply a journaled commit. Every step can be repeated, so this also resumes one cut short."""
+        for staged, live, backup, existed, _, _ in staging.moves(journal):
+            if not os.path.exists(staged):
+                continue  # Already moved
+            if existed and os.path.exists(live) and not os.path.exists(backup):
+                os.makedirs(os.path.dirname(backup), exist_ok=True)
+                os.replace(live, backup)
+            os.makedirs(os.path.dirname(live), exist_ok=True)
+            os.replace(staged, live)
+        # The renames must be on disk before the journal that can redo them is cleared
+        self.writer.sync([live for _, live, _, _, _, _ in staging.moves(journal)], data=False)
+
+        # Every file is in place: only now does the state store describe the new version
+        for _, live, _, _, remote_path, file_hash in staging.moves(journal):
+            if remote_path is not None:
+                self.hash_cache.put(live, file_hash)
+                self.record_downloaded_file(remote_path, file_hash, live)
+        sync_state = self.load_sync_state()
+        if journal["index"]:
+            sync_state.update(journal["sync_state"])
+        sync_state["complete"] = journal["complete"]
+        self.save_sync_state(sync_state)
+        # A partial commit leaves failed downloads behind; their .part files let the next run resume them
+        staging.clear(keep_parts=not journal["complete"])
+
+    def roll_back(self, staging, journal):
+        """Undo a journaled commit, restoring the replaced files from their backups."""
+        for staged, live, backup, existed, _, _ in staging.moves(journal):
+            if os.path.exists(backup):
+                os.replace(backup, live)
+            elif not existed and not os.path.exists(staged) and os.path.exists(live):
+                os.remove(live)  # Added by the commit
+        # The state store and sync_state were only updated after the last move, so they still match
+        staging.clear()
+
+    def plan_update(self, manifest, old_manifest=None):
+        """Return the Manifest entries that need to be downloaded, in Manifest order."""
+        downloaded_files = self.state_store.all_hashes()
+        candidate_files = []
+        to_verify = {}  # entry -> expected hash
+        for entry in manifest:
+            if entry.if_missing:
+                if os.path.exists(entry.local_path):
+                    continue
+
+            recorded_hash = downloaded_files.get(entry.remote_path)
+            if recorded_hash is not None:
+                if os.path.exists(entry.local_path):
+                    old_entry = old_manifest.get(entry.manifest_path) if old_manifest else None
+                    if (old_entry is not None
+                            and old_entry.expected_hash == entry.expected_hash
+                            and entry.expected_hash.lower() == recorded_hash.lower()):
+                        continue  # Unchanged since the last complete patch
+                    # Compare against the current Hashes entry so server-side updates are picked up
+                    to_verify[entry] = entry.expected_hash or recorded_hash
+                else:
+                    print(f"Arquivo {entry.manifest_path} está faltando. Rebaixando...")
+            candidate_files.append(entry)
+
+        current_hashes = self.hash_files({entry.manifest_path: entry.local_path for entry in to_verify})
+
+        pending_files = []
+        for entry in candidate_files:
+            if entry in to_verify:
+                current_hash = current_hashes.get(entry.manifest_path)
+                if current_hash and current_hash.lower() == to_verify[entry].lower():
+                    continue
+                print(f"Arquivo {entry.manifest_path} está desatualizado ou corrompido. Rebaixando...")
+            pending_files.append(entry)
+        return pending_files
+
+    def select_servers(self):
+        """Build the server list for this run, ranking the mirrors by speed when there are any."""
+        self.servers = list(dict.fromkeys([self.base_url] + self.mirrors))
+        if len(self.servers) > 1:
+            with self.telemetry.span("mirror_probe") as span:
+                self.servers = self.rank_servers(self.servers)
+                span["servers"] = self.servers
+            self.base_url = self.servers[0]
+
+    def rank_servers(self, servers):
+        """Order the servers by how long each takes to send the start of its Hashes, probing them at the same time.
+
+        Only MIRROR_PROBE_SIZE bytes are read, so polling with mirrors stays cheap when nothing changed.
+        """
+        import requests
+
+        cached = _mirror_rankings.get(tuple(servers))
+        if cached and cached[1] > time.monotonic():
+            return list(cached[0])
+
+        def probe(base_url):
+            started = time.perf_counter()
+            try:
+                # Plain request without retries: a slow or dead mirror must not hold up the patch
+                headers = {"Range": f"bytes=0-{MIRROR_PROBE_SIZE - 1}", "Accept-Encoding": "identity"}
+                with requests.get(f"{base_url}/Hashes", headers=headers, stream=True,
+                                  timeout=MIRROR_PROBE_TIMEOUT) as response:
+                    response.raise_for_status()
+                    # A server without Range support sends the whole file; stop reading after the probe size
+                    response.raw.read(MIRROR_PROBE_SIZE)
+                return time.perf_counter() - started
+            except requests.RequestException as e:
+                print(f"Servidor {base_url} não respondeu: {e}")
+                return float("inf")
+
+        with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            timings = dict(zip(servers, executor.map(probe, servers)))
+        # Unreachable servers stay at the end as a last resort
+        ranked = sorted(servers, key=lambda base_url: timings[base_url])
+        print("Servidores: " + ", ".join(
+            f"{url} ({timings[url] * 1000:.0f} ms)" if timings[url] != float("inf") else f"{url} (sem resposta)"
+            for url in ranked
+        ))
+        _mirror_rankings[tuple(servers)] = (ranked, time.monotonic() + MIRROR_RANKING_TTL)
+        return list(ranked)
+
+    def demote_server(self, base_url):
+        """Move a failing server to the end of the list, for the rest of the run and the next patches."""
+        with self.servers_lock:
+            if len(self.servers) < 2 or base_url not in self.servers:
+                return
+            self.servers = [url for url in self.servers if url != base_url] + [base_url]
+            self.base_url = self.servers[0]
+            print(f"Servidor {base_url} falhou, usando {self.base_url}")
+        self.telemetry.count("server_failovers")
+        for key, (ranked, expires_at) in list(_mirror_rankings.items()):
+            if base_url in ranked:
+                _mirror_rankings[key] = ([url for url in ranked if url != base_url] + [base_url], expires_at)
+
+    def sync_index_files(self, manifest_path, hashes_path, sync_state):
+        """Fetch Manifest and Hashes from the same server, failing over to the next one on errors."""
+        # A copy: demote_server() reorders self.servers while this loop runs
+        servers = list(self.servers)
+        for base_url in servers:
+            try:
+                new_manifest_path = self.sync_index_file(f"{base_url}/Manifest", manifest_path, sync_state)
+                new_hashes_path = self.sync_index_file(f"{base_url}/Hashes", hashes_path, sync_state)
+                return new_manifest_path, new_hashes_path
+            except Exception as e:
+                if base_url == servers[-1] or self.stop_download():
+                    raise
+                print(f"Erro ao baixar o Manifest/Hashes de {base_url}: {e}")
+                self.demote_server(base_url)
+
+    def sync_index_file(self, url, local_path, sync_state):
+        """Fetch Manifest/Hashes with a conditional GET, returning the new file's path or None if unchanged."""
+        name = os.path.basename(local_path)
+        validators = sync_state.setdefault(name, {})
+        headers = {}
+        if os.path.exists(local_path):
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        new_path = local_path + ".new"
+        with self.telemetry.span("sync_index", file=name) as span:
+            response = self.download_file(url, new_path, headers)
+            span["status"] = response.status_code
+        if response.status_code == 304:
+            return None
+
+        validators["etag"] = response.headers.get("ETag")
+        validators["last_modified"] = response.headers.get("Last-Modified")
+        return new_path
+
+    def load_sync_state(self):
+        """Load the Manifest/Hashes validators saved for this install path."""
+        if os.path.exists(SYNC_STATE_PATH):
+            try:
+                with open(SYNC_STATE_PATH, "r") as f:
+                    return json.load(f).get(self.install_path, {})
+            except (OSError, ValueError) as e:
+                print(f"Erro ao carregar o estado de sincronização: {e}")
+        return {}
+
+    def save_sync_state(self, sync_state):
+        """Save the Manifest/Hashes validators for this install path."""
+        data = {}
+        if os.path.exists(SYNC_STATE_PATH):
+            try:
+                with open(SYNC_STATE_PATH, "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                pass
+        data[self.install_path] = sync_state
+        os.makedirs(os.path.dirname(SYNC_STATE_PATH), exist_ok=True)
+        with self.telemetry.span("save_sync_state"), open(SYNC_STATE_PATH, "w") as f:
+            json.dump(data, f)
+
+    def download_pending_files(self, queue):
+        """Download the entries of a DownloadQueue using up to max_workers concurrent downloads."""
+        failed_files = []
+        completed = 0
+
+        def fetch():
+            # The entry is picked when a worker frees up, so sizes learned meanwhile count
+            entry = queue.pop()
+            if self.stop_download():
+                return entry, None
+            self.on_status(f"Baixando: {entry.manifest_path}")
+            try:
+                self.download_or_update_file(entry)
+            except Exception as e:
+                return entry, e
+            return entry, None
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = [executor.submit(fetch) for _ in range(len(queue))]
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                entry, error = future.result()
+                if error is not None:
+                    failed_files.append(entry.manifest_path)
+                    self.telemetry.count("files_failed")
+
+                completed += 1
+                self.on_files_completed(completed, len(queue))
+
+                if self.stop_download():
+                    # Drop the queued files, the running ones abort on their next chunk
+                    for pending in futures:
+                        pending.cancel()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        return failed_files
+
+    def calculate_total_download_size(self, pending_files, on_size=_ignore):
+        """Calculate how many bytes are left to download for the pending files, passing each to on_size(entry, size)."""
+        total_size = 0
+
+        def remaining_size(entry):
+            if self.stop_download():
+                return 0
+            file_url = f"{self.base_url}/{entry.remote_path.lstrip('/')}"
+            # identity: the size of the file itself, not of a compressed transfer
+            response = self.session.head(file_url, headers={"Accept-Encoding": "identity"}, timeout=HTTP_TIMEOUT)
+            if response.status_code != 200:
+                return 0
+            size = int(response.headers.get("content-length", 0))
+
+            # Bytes already in a .part file will be resumed, not downloaded again
+            part_path = entry.local_path + ".part"
+            if os.path.exists(part_path):
+                size -= os.path.getsize(part_path)
+            size = max(size, 0)
+            on_size(entry, size)
+            return size
+
+        try:
+            # Only the pending files are probed, HEAD_WORKERS at a time over the shared session
+            with self.telemetry.span("size_probe", files=len(pending_files)), \
+                    ThreadPoolExecutor(max_workers=HEAD_WORKERS) as executor:
+                for size in executor.map(remaining_size, pending_files):
+                    total_size += size
+        except Exception as e:
+            print(f"Erro ao calcular o tamanho total do download: {e}")
+
+        # Report the total size
+        self.on_total_size(total_size)
+        return total_size
+
+    def download_or_update_file(self, entry):
+        """Download or update a file."""
+        with self.telemetry.span("file", path=entry.manifest_path) as span:
+            self.download_entry(entry, span)
+
+    def download_entry(self, entry, span):
+        """Body of download_or_update_file; span holds the file's trace args."""
+        file_path = entry.manifest_path
+        download_file_path = entry.remote_path
+        local_file_path = entry.local_path
+        expected_hash = entry.expected_hash
+        # Prefetching writes the new version to the staging directory; the install keeps the old one
+        target_path = self.staging.path_for(entry) if self.staging is not None else local_file_path
+
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+        if os.path.exists(local_file_path):
+            current_hash = self.hash_file(local_file_path, file_path).lower()
+
+            if current_hash == expected_hash.lower():
+                self.record_downloaded_file(download_file_path, expected_hash, local_file_path)
+                span["result"] = "up_to_date"
+                return
+            else:
+                print(f"Arquivo {file_path} está corrompido ou desatualizado. Hash esperado: {expected_hash}, Hash atual: {current_hash}")
+
+        if target_path != local_file_path and os.path.exists(target_path):
+            if self.hash_file(target_path, file_path).lower() == expected_hash.lower():
+                self.staging.record(entry, expected_hash.lower())  # Staged by an earlier prefetch
+                span["result"] = "staged"
+                return
+
+        part_path = target_path + ".part"
+        journal_path = part_path + ".json"
+
+        if self.content_store is not None and expected_hash:
+            # Another install may already have this exact file
+            try:
+                if self.content_store.materialize(expected_hash, target_path, allow_hardlink=not entry.if_missing):
+                    self.discard_part(part_path, journal_path)
+                    # The total counted this file through its HEAD request, so it moves the progress too
+                    size = os.path.getsize(target_path)
+                    self.progress.add(size, size, size)
+                    self.hash_cache.put(target_path, expected_hash.lower())
+                    self.record_new_version(entry, expected_hash, target_path)
+                    self.telemetry.count("files_from_store")
+                    span["result"] = "store"
+                    return
+            except OSError as e:
+                print(f"Erro ao copiar {file_path} do cache de arquivos: {e}")
+
+        self.on_status(f"Baixando: {file_path}")
+        started = time.perf_counter()
+        # LAN peers first, except for "+" files which they don't share, then the patch servers, fastest first
+        peers = [] if entry.if_missing else self.peers
+        sources = peers + (self.servers or [self.base_url])
+        for base_url in sources:
+            file_url = f"{base_url}/{download_file_path.lstrip('/')}"
+            try:
+                downloaded_hash = self.fetch_entry(entry, file_url, target_path, part_path, journal_path, span)
+            except Exception as e:
+                if base_url == sources[-1] or self.stop_download():
+                    print(f"Falha ao fazer o download de {file_path}: {e}")
+                    span["result"] = "failed"
+                    raise
+                print(f"Falha ao baixar {file_path} de {base_url}, tentando o próximo: {e}")
+                # Missing a file is fine, failing isn't
+                if getattr(getattr(e, "response", None), "status_code", None) != 404:
+                    if base_url in peers:
+                        self.drop_peer(base_url)
+                    else:
+                        self.demote_server(base_url)
+                continue
+
+            self.hash_cache.put(target_path, downloaded_hash)
+            self.record_new_version(entry, expected_hash, target_path)
+            self.add_to_content_store(entry, downloaded_hash, target_path)
+            self.telemetry.count("files_downloaded")
+            if base_url in peers:
+                self.telemetry.count("files_from_peers")
+            self.telemetry.observe("file_latency", time.perf_counter() - started)
+            span.update(result="downloaded", source=base_url)
+            return
+
+    def select_peers(self, hashes_path, candidates):
+        """Return the peers whose Hashes is identical to the one just synced from the server."""
+        import requests
+
+        expected = self.calculate_md5(hashes_path)
+
+        def check(base_url):
+            try:
+                # Plain request without retries: a peer that doesn't answer right away is skipped
+                response = requests.get(f"{base_url}/Hashes", timeout=(1, 5))
+                if response.status_code == 200 and hashlib.md5(response.content).hexdigest() == expected:
+                    return base_url
+                print(f"Launcher {base_url} não está atualizado, ignorando")
+            except requests.RequestException as e:
+                print(f"Launcher {base_url} não respondeu: {e}")
+            return None
+
+        candidates = list(dict.fromkeys(candidates))
+        with ThreadPoolExecutor(max_workers=max(1, len(candidates))) as executor:
+            peers = [base_url for base_url in executor.map(check, candidates) if base_url]
+        if peers:
+            print(f"Baixando também de: {', '.join(peers)}")
+        return peers
+
+    def drop_peer(self, base_url):
+        """Stop using a peer for the rest of the run."""
+        with self.peers_lock:
+            self.peers = [p for p in self.peers if p != base_url]
+
+    def fetch_entry(self, entry, file_url, target_path, part_path, journal_path, span):
+        """Download an entry from file_url and move it to target_path. Returns its MD5, raises if it doesn't match."""
+        expected_hash = entry.expected_hash
+        # Download into a .part file, resuming a previous attempt for the same file version
+        offset = self.resume_offset(part_path, journal_path, file_url, expected_hash)
+        if offset:
+            print(f"Retomando o download de {entry.manifest_path} a partir de {offset} bytes")
+        else:
+            with open(journal_path, "w") as f:
+                json.dump({"url": file_url, "expected_hash": expected_hash}, f)
+        hash_md5 = None
+        if (self.delta_patching and not offset and os.path.exists(entry.local_path)
+                and os.path.getsize(entry.local_path) >= delta.DELTA_MIN_SIZE):
+            hash_md5 = self.download_delta(file_url, entry.local_path, part_path, expected_hash, span)
+        if hash_md5 is None and entry.compression and not offset:
+            hash_md5 = self.download_compressed(file_url, part_path, entry.compression, expected_hash, span)
+        if hash_md5 is None:
+            # The MD5 is computed from the chunks as they're written, not by reading the file back
+            hash_md5 = hashlib.md5()
+            response = self.download_file(file_url, part_path, offset=offset, hasher=hash_md5)
+            span.update(offset=offset, status=response.status_code)
+        downloaded_hash = hash_md5.hexdigest()
+
+        if downloaded_hash != expected_hash.lower():
+            print(f"Erro: O arquivo baixado {entry.remote_path} está corrompido. Hash esperado: {expected_hash}, Hash baixado: {downloaded_hash}")
+            self.discard_part(part_path, journal_path)
+            raise Exception(f"Arquivo {entry.remote_path} está corrompido após o download.")
+
+        os.replace(part_path, target_path)
+        os.remove(journal_path)
+        return downloaded_hash
+
+    def add_to_content_store(self, entry, file_hash, path=None):
+        """Share a verified install (or staged) file with the other installs."""
+        if self.content_store is None:
+            return
+        try:
+            # "+" files are config files the player edits; a hardlink would leak the edits into the store
+            self.content_store.add(path or entry.local_path, file_hash, allow_hardlink=not entry.if_missing)
+        except OSError as e:
+            print(f"Erro ao guardar {entry.manifest_path} no cache de arquivos: {e}")
+
+    def seed_content_store(self, manifest):
+        """Add the files of a fully patched install that the store doesn't have yet.
+
+        Only done when they can be linked: copying a whole install on another disk would hold up the patch
+        and double its size. Downloaded files are still added as they arrive.
+        """
+        if self.content_store is None or not self.content_store.can_link(self.install_path):
+            return
+        known_hashes = self.content_store.known_hashes()
+        with self.telemetry.span("store_seed") as span:
+            added = 0
+            for entry in manifest:
+                expected_hash = entry.expected_hash.lower()
+                if entry.if_missing or not expected_hash or expected_hash in known_hashes:
+                    continue  # "+" files are never verified, the player may have changed them
+                if not os.path.exists(entry.local_path):
+                    continue
+                if self.stop_download():
+                    break
+                self.add_to_content_store(entry, expected_hash)
+                known_hashes.add(expected_hash)
+                added += 1
+            span["added"] = added
+
+    def download_delta(self, url, local_path, part_path, expected_hash, span):
+        """Rebuild a changed file into part_path from its unchanged local blocks plus Range requests.
+
+        Returns the MD5 hasher of the rebuilt file, or None if the full file has to be downloaded instead.
+        """
+        try:
+            response = self.session.get(url + delta.BLOCK_INDEX_SUFFIX, timeout=HTTP_TIMEOUT)
+            if response.status_code == 404:
+                return None  # The server doesn't publish blocks for this file
+            response.raise_for_status()
+            index = response.json()
+            if index["md5"].lower() != expected_hash.lower():
+                print(f"Índice de blocos de {url} desatualizado, baixando o arquivo inteiro")
+                return None
+
+            with self.telemetry.span("delta_match", path=local_path):
+                sources = delta.match_blocks(local_path, index, stop=self.stop_download)
+            if self.stop_download():
+                raise Exception("Download interrompido pelo jogador")
+            runs = delta.plan_ranges(index, sources)
+
+            hash_md5 = hashlib.md5()
+            reused_bytes = 0
+            with open(local_path, "rb") as local, self.writer.open(part_path, size=index["size"]) as part:
+                for start, end, local_offset in runs:
+                    if local_offset is None:
+                        self.fetch_range(url, start, end, part, hash_md5, index["size"])
+                        continue
+                    local.seek(local_offset)
+                    remaining = end - start
+                    while remaining > 0:
+                        block = local.read(min(remaining, HASH_BUFFER_SIZE))
+                        if not block:
+                            raise Exception(f"{local_path} mudou durante o patch por blocos")
+                        part.write(block)
+                        hash_md5.update(block)
+                        remaining -= len(block)
+                        # The total counted the whole file, so reused blocks move the progress too
+                        self.progress.add(len(block), end - remaining, index["size"])
+                    reused_bytes += end - start
+                self.writer.finish(part)
+
+            if hash_md5.hexdigest() != expected_hash.lower():
+                print(f"Patch por blocos de {url} gerou um hash diferente, baixando o arquivo inteiro")
+                return None
+        except Exception as e:
+            if self.stop_download():
+                raise
+            print(f"Patch por blocos de {url} falhou, baixando o arquivo inteiro: {e}")
+            return None
+
+        fetched_bytes = index["size"] - reused_bytes
+        print(f"Patch por blocos de {url}: {fetched_bytes} bytes baixados, {reused_bytes} reaproveitados")
+        self.telemetry.count("delta_bytes_reused", reused_bytes)
+        span.update(delta=True, reused_bytes=reused_bytes)
+        return hash_md5
+
+    def fetch_range(self, url, start, end, out, hasher, file_size):
+        """Download bytes [start, end) of url into an open file."""
+        requested = time.perf_counter()
+        headers = {"Range": f"bytes={start}-{end - 1}", "Accept-Encoding": "identity"}
+        with self.session.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as response:
+            self.telemetry.observe("ttfb", time.perf_counter() - requested)
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise Exception("O servidor não suporta Range")
+
+            received = 0
+            for chunk in self.writer.chunks(response):
+                if self.stop_download():
+                    raise Exception("Download interrompido pelo jogador")
+                if chunk:
+                    self.rate_limiter.consume(len(chunk), self.stop_download)
+                    received += len(chunk)
+                    if received > end - start:
+                        raise Exception(f"O servidor enviou mais de {end - start} bytes para {url}")
+                    out.write(chunk)
+                    hasher.update(chunk)
+                    self.progress.add(len(chunk), start + received, file_size)
+            self.telemetry.count("bytes_downloaded", received)
+            if received != end - start:
+                raise Exception(f"Download incompleto de {url}: {received} de {end - start} bytes")
+
+    def download_compressed(self, url, part_path, compression, expected_hash, span):
+        """Download the compressed sidecar of url, decompressing it into part_path as it streams.
+
+        Returns the MD5 hasher of the decompressed file, or None if the file has to be downloaded uncompressed.
+        """
+        if compression not in compress.available_formats():
+            return None
+        sidecar_url = url + compress.SIDECAR_SUFFIXES[compression]
+        hash_md5 = hashlib.md5()
+        received = 0
+        written = 0
+        try:
+            stream = compress.decompressor(compression)
+            requested = time.perf_counter()
+            # identity: the sidecar is already compressed, a transfer encoding on top would only cost CPU
+            headers = {"Accept-Encoding": "identity"}
+            with self.session.get(sidecar_url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as response:
+                self.telemetry.observe("ttfb", time.perf_counter() - requested)
+                if response.status_code == 404:
+                    return None  # Not published by this server or peer
+                response.raise_for_status()
+                content_length = int(response.headers.get("content-length") or 0)
+
+                with self.writer.open(part_path) as f:
+                    for chunk in self.writer.chunks(response, encoded=True):
+                        if self.stop_download():
+                            raise Exception("Download interrompido pelo jogador")
+                        if chunk:
+                            self.rate_limiter.consume(len(chunk), self.stop_download)
+                            received += len(chunk)
+                            data = stream.decompress(chunk)
+                            f.write(data)
+                            hash_md5.update(data)
+                            written += len(data)
+                            # The total counts decompressed bytes, like the sizes from the HEAD requests
+                            self.progress.add(len(data), received, content_length)
+                    self.writer.finish(f)
+            if not stream.eof:
+                raise Exception(f"Download incompleto de {sidecar_url}")
+        except Exception as e:
+            if self.stop_download():
+                raise
+            print(f"Download comprimido de {url} falhou, baixando o arquivo sem compressão: {e}")
+            return None
+        finally:
+            self.telemetry.count("bytes_downloaded", received)
+
+        if hash_md5.hexdigest() != expected_hash.lower():
+            print(f"Arquivo comprimido de {url} gerou um hash diferente, baixando o arquivo sem compressão")
+            return None
+
+        self.telemetry.count("compressed_bytes_saved", written - received)
+        span.update(compression=compression, wire_bytes=received)
+        return hash_md5
+
+    @staticmethod
+    def resume_offset(part_path, journal_path, url, expected_hash):
+        """Return how many bytes of a previous .part download can be kept, discarding stale parts."""
+        if not os.path.exists(part_path):
+            return 0
+
+        try:
+            with open(journal_path, "r") as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            journal = {}
+
+        # Same file and version from any server or peer: the final MD5 check covers mixed sources
+        same_path = urllib.parse.urlsplit(journal.get("url", "")).path == urllib.parse.urlsplit(url).path
+        if same_path and journal.get("expected_hash") == expected_hash:
+            return os.path.getsize(part_path)
+
+        # The part belongs to another version of the file
+        Patcher.discard_part(part_path, journal_path)
+        return 0
+
+    @staticmethod
+    def discard_part(part_path, journal_path):
+        """Remove a partial download and its journal."""
+        for path in (part_path, journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def download_file(self, url, local_path, headers=None, offset=0, hasher=None):
+        """Download a file with progress tracking, appending from offset if the server supports ranges.
+
+        If a hashlib object is given it's fed the whole file, resumed bytes included, as it's written.
+        Compressed transfers (Content-Encoding) are decompressed as they stream; the length check and the rate
+        limit count the bytes on the wire.
+        """
+        headers = dict(headers or {})
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            # Ranges count bytes of the file itself, not of a compressed transfer
+            headers["Accept-Encoding"] = "identity"
+
+        requested = time.perf_counter()
+        with self.session.get(url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as response:
+            # With stream=True get() returns once the headers arrive
+            self.telemetry.observe("ttfb", time.perf_counter() - requested)
+            retries = getattr(response.raw, "retries", None)
+            if retries is not None and retries.history:
+                self.telemetry.count("http_retries", len(retries.history))
+
+            if offset and response.status_code == 416:
+                # The part is already complete, the hash check decides
+                if hasher is not None:
+                    self.update_hash_from_file(hasher, local_path)
+                return response
+            response.raise_for_status()
+            if response.status_code == 304:
+                return response  # Not modified, keep the local copy
+            if response.status_code != 206:
+                offset = 0  # Range not supported, start over
+            elif hasher is not None:
+                self.update_hash_from_file(hasher, local_path, offset)
+
+            # With a Content-Encoding, Content-Length is the size of the compressed body
+            content_length = int(response.headers.get("content-length") or 0)
+            total_size = offset + content_length
+            encoded = response.headers.get("content-encoding", "identity").lower() != "identity"
+            downloaded_bytes = offset
+            wire_bytes = 0
+            write_time = 0.0
+
+            try:
+                # A compressed body's Content-Length says nothing about the size on disk
+                with self.writer.open(local_path, offset, 0 if encoded else total_size) as f:
+                    for chunk in self.writer.chunks(response, encoded):
+                        if self.stop_download():
+                            raise Exception("Download interrompido pelo jogador")
+
+                        if chunk:
+                            # raw.tell() is the count of bytes read off the socket, before decompression
+                            received = response.raw.tell() - wire_bytes
+                            wire_bytes += received
+                            self.rate_limiter.consume(received, self.stop_download)
+                            downloaded_bytes += len(chunk)
+                            if content_length and wire_bytes > content_length:
+                                raise Exception(f"O servidor enviou mais de {content_length} bytes para {url}")
+
+                            write_started = time.perf_counter()
+                            f.write(chunk)
+                            write_time += time.perf_counter() - write_started
+                            if hasher is not None:
+                                hasher.update(chunk)
+
+                            # Progress is coalesced and reported at PROGRESS_UPDATE_INTERVAL
+                            self.progress.add(len(chunk), offset + wire_bytes, total_size)
+                    write_started = time.perf_counter()
+                    self.writer.finish(f)
+                    write_time += time.perf_counter() - write_started
+                wire_bytes = response.raw.tell()
+            finally:
+                self.telemetry.count("bytes_downloaded", wire_bytes)
+                self.telemetry.observe("disk_write", write_time)
+
+            if content_length and wire_bytes != content_length:
+                raise Exception(f"Download incompleto de {url}: {wire_bytes} de {content_length} bytes")
+            if encoded:
+                self.telemetry.count("compressed_bytes_saved", downloaded_bytes - offset - wire_bytes)
+
+        return response
+
+    def report_progress(self, file_bytes, file_total, total_bytes, bytes_per_second):
+        """Pass the coalesced progress to the callbacks."""
+        self.on_file_progress(file_bytes, file_total)
+        self.on_speed(total_bytes, bytes_per_second)
+
+    def record_downloaded_file(self, download_file_path, file_hash, local_file_path):
+        """Save a verified file to the state store along with its size and mtime."""
+        st = os.stat(local_file_path)
+        with self.telemetry.span("state_save", path=download_file_path):
+            self.state_store.set_file(download_file_path, file_hash, st.st_size, st.st_mtime_ns)
+
+    def record_new_version(self, entry, file_hash, path):
+        """Record a verified download: in the state store, or in the staging state while prefetching."""
+        if self.staging is not None:
+            self.staging.record(entry, file_hash.lower())
+        else:
+            self.record_downloaded_file(entry.remote_path, file_hash, path)
+
+    def save_hash_cache(self):
+        """Save the hash cache, keeping the patch result if it can't be written."""
+        # Staged files are cached so prefetch polls don't rehash them, but they're gone once committed
+        self.hash_cache.prune(os.path.join(self.install_path, STAGING_DIR_NAME))
+        try:
+            self.hash_cache.save()
+        except OSError as e:
+            print(f"Erro ao salvar o cache de hashes: {e}")
+
+    def save_trace(self):
+        """Write the run's telemetry to TRACE_DIR, keeping the patch result if it can't be written."""
+        try:
+            self.trace_path = self.telemetry.save()
+            print(f"Trace do patch salvo em {self.trace_path}")
+        except OSError as e:
+            print(f"Erro ao salvar o trace do patch: {e}")
+
+    def hash_files(self, files):
+        """Hash {key: local path} files in parallel and return {key: md5}, or None for unreadable files."""
+        current_hashes = {}
+
+        def work(key, local_path):
+            if self.stop_download():
+                return None
+            try:
+                return self.hash_file(local_path, key)
+            except OSError as e:
+                print(f"Erro ao calcular o hash de {key}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+            futures = {executor.submit(work, key, local_path): key for key, local_path in files.items()}
+            for future in as_completed(futures):
+                current_hashes[futures[future]] = future.result()
+
+        return current_hashes
+
+    def hash_file(self, file_path, display_path=None):
+        """Return the MD5 of a file, reusing the cached hash if the file didn't change."""
+        if not self.deep_verify:
+            cached_hash = self.hash_cache.get(file_path)
+            if cached_hash:
+                self.telemetry.count("hash_cache_hits")
+                return cached_hash
+
+        self.on_hashing(f"Hashing: {display_path or file_path}")
+        with self.telemetry.span("hash", path=display_path or file_path):
+            started = time.perf_counter()
+            file_hash = self.calculate_md5(file_path)
+            self.telemetry.observe("hash", time.perf_counter() - started)
+        self.telemetry.count("hash_cache_misses")
+        self.hash_cache.put(file_path, file_hash)
+        return file_hash
+
+    @staticmethod
+    def calculate_md5(file_path, buffer_size=HASH_BUFFER_SIZE):
+        """Calculate the MD5 hash of a file."""
+        hash_md5 = hashlib.md5()
+        Patcher.update_hash_from_file(hash_md5, file_path, buffer_size=buffer_size)
+        return hash_md5.hexdigest()
+
+    @staticmethod
+    def update_hash_from_file(hasher, file_path, limit=None, buffer_size=HASH_BUFFER_SIZE):
+        """Feed a hashlib object the first limit bytes of a file (all of it if limit is None)."""
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        remaining = limit
+        with open(file_path, "rb", buffering=0) as f:
+            while remaining is None or remaining > 0:
+                size = f.readinto(view if remaining is None or remaining >= buffer_size else view[:remaining])
+                if not size:
+                    break
+                hasher.update(view[:size])
+                if remaining is not None:
+                    remaining -= size
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import socket
+import threading
+import email.utils
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+PEER_PORT = 2597  # HTTP port of a launcher sharing its install on the LAN
+PEER_DISCOVERY_PORT = 2598  # UDP port answering discovery broadcasts
+PEER_DISCOVERY_MAGIC = b"EPIC_SHARD_PEER?"
+PEER_DISCOVERY_TIMEOUT = 0.5  # Seconds spent collecting discovery answers
+# Content-Encodings served from pre-compressed sidecars, like nginx's gzip_static, preferred first
+CONTENT_ENCODINGS = (("zstd", ".zst"), ("gzip", ".gz"))
+
+
+class PatchRequestHandler(BaseHTTPRequestHandler):
+    """Serve files the way the patch server does: GET/HEAD with Range, ETag and Last-Modified.
+
+    Requests without Range that accept a Content-Encoding get the file's compressed sidecar when there is one.
+    """
+
+    protocol_version = "HTTP/1.1"
+    block_size = 64 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def resolve(self, path):
+        """Return the local file for a request path, or None for 404. Subclasses map paths; this serves nothing."""
+        return None
+
+    def throttle(self, nbytes):
+        """Called before every block of a response body is sent."""
+
+    def do_GET(self):
+        f = self.send_head()
+        if f:
+            try:
+                self.copy_body(f)
+            finally:
+                f.close()
+
+    def do_HEAD(self):
+        f = self.send_head()
+        if f:
+            f.close()
+
+    def send_empty(self, status, **headers):
+        """Send a response without body."""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name.replace("_", "-"), value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_head(self):
+        """Send the status and headers; return the open file positioned at the body, or None."""
+        request_path = urllib.parse.unquote(self.path.split("?", 1)[0])
+        path = self.resolve(request_path)
+        if path is None or not os.path.isfile(path):
+            self.send_empty(404)
+            return None
+
+        encoding = None
+        if "Range" not in self.headers:
+            accepted = {token.split(";")[0].strip().lower() for token in self.headers.get("Accept-Encoding", "").split(",")}
+            for name, suffix in CONTENT_ENCODINGS:
+                sidecar_path = self.resolve(request_path + suffix) if name in accepted else None
+                if sidecar_path is not None and os.path.isfile(sidecar_path):
+                    path, encoding = sidecar_path, name
+                    break
+
+        st = os.stat(path)
+        size = st.st_size
+        etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_empty(304, ETag=etag)
+            return None
+
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            first, _, last = range_header[len("bytes="):].partition("-")
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if start >= size:
+                self.send_empty(416, Content_Range=f"bytes */{size}")
+                return None
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Vary", "Accept-Encoding")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", email.utils.formatdate(st.st_mtime, usegmt=True))
+        self.end_headers()
+
+        f = open(path, "rb")
+        f.seek(start)
+        self.remaining = end - start + 1
+        return f
+
+    def copy_body(self, source):
+        """Send the requested range of source."""
+        while self.remaining > 0:
+            block = source.read(min(self.block_size, self.remaining))
+            if not block:
+                break
+            self.throttle(len(block))
+            self.wfile.write(block)
+            self.remaining -= len(block)
+
+
+class PeerRequestHandler(PatchRequestHandler):
+    """Serve only /Manifest, /Hashes and the files they list, and nothing while the install is being patched."""
+
+    def resolve(self, path):
+        return self.server.peer.files.get(path)
+
+    def send_head(self):
+        if self.server.peer.paused:
+            self.send_empty(503, Retry_After="60")
+            return None
+        return super().send_head()
+
+
+class PeerServer:
+    """Share a patched install with other launchers on the LAN, in the patch server's layout."""
+
+    def __init__(self, install_path, port=PEER_PORT, discovery_port=PEER_DISCOVERY_PORT):
+        self.install_path = install_path
+        self.port = port
+        self.discovery_port = discovery_port
+        self.files = {}  # request path -> local path
+        self.paused = False  # Set while the install is being patched
+        self.http_server = None
+        self.discovery_socket = None
+
+    def refresh(self):
+        """Rebuild the list of served files from the install's Manifest."""
+        from patcher import Manifest
+
+        manifest_path = os.path.join(self.install_path, "Manifest")
+        hashes_path = os.path.join(self.install_path, "Hashes")
+        files = {"/Manifest": manifest_path, "/Hashes": hashes_path}
+        for entry in Manifest.load(manifest_path, hashes_path, self.install_path):
+            # "+" files are the player's own config, they are not shared
+            if not entry.if_missing:
+                files[entry.remote_path] = entry.local_path
+        self.files = files
+
+    def start(self):
+        """Start serving in background threads."""
+        self.refresh()
+        self.http_server = ThreadingHTTPServer(("", self.port), PeerRequestHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.peer = self
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+
+        self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.discovery_socket.bind(("", self.discovery_port))
+        threading.Thread(target=self.answer_discovery, daemon=True).start()
+        print(f"Compartilhando {self.install_path} na porta {self.port}")
+
+    def answer_discovery(self):
+        """Reply to discovery broadcasts with the HTTP port."""
+        reply = json.dumps({"port": self.port}).encode()
+        while True:
+            try:
+                data, address = self.discovery_socket.recvfrom(1024)
+            except OSError:
+                return  # Socket closed by stop()
+            if data == PEER_DISCOVERY_MAGIC and not self.paused:
+                self.discovery_socket.sendto(reply, address)
+
+    def stop(self):
+        """Stop serving."""
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+        if self.discovery_socket is not None:
+            self.discovery_socket.close()
+            self.discovery_socket = None
+
+
+def discover_peers(timeout=PEER_DISCOVERY_TIMEOUT, discovery_port=PEER_DISCOVERY_PORT):
+    """Broadcast a discovery query on the LAN and return the base URLs of the peers that answer."""
+    peers = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            sock.sendto(PEER_DISCOVERY_MAGIC, ("<broadcast>", discovery_port))
+        except OSError as e:
+            print(f"Erro ao procurar launchers na rede local: {e}")
+            return peers
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, (address, _) = sock.recvfrom(1024)
+                url = f"http://{address}:{int(json.loads(data)['port'])}"
+            except socket.timeout:
+                break
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            if url not in peers:
+                peers.append(url)
+    return peers
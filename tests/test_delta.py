@@ -0,0 +1,78 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+import delta
+
+
+class MatchBlocksTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rng = random.Random(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def match(self, remote, local, **kwargs):
+        index = delta.build_block_index(self.write("remote", remote))
+        local_path = self.write("local", local)
+        started = time.monotonic()
+        sources = delta.match_blocks(local_path, index, **kwargs)
+        return index, sources, time.monotonic() - started
+
+    def rebuild(self, index, sources, local, remote):
+        """Reassemble the remote file like download_delta, returning it and the bytes that had to be fetched."""
+        data = bytearray()
+        fetched = 0
+        for start, end, local_offset in delta.plan_ranges(index, sources):
+            if local_offset is None:
+                data += remote[start:end]
+                fetched += end - start
+            else:
+                data += local[local_offset:local_offset + end - start]
+        return bytes(data), fetched
+
+    def test_zero_padding_with_trailing_data(self):
+        # The padding matches claimed blocks and the short last block at every byte position
+        remote = self.rng.randbytes(5 * 1024 * 1024) + bytes(300 * 1024)
+        local = remote + self.rng.randbytes(10 * 1024)
+        index, sources, elapsed = self.match(remote, local)
+        self.assertLess(elapsed, 2)
+        data, fetched = self.rebuild(index, sources, local, remote)
+        self.assertEqual(data, remote)
+        self.assertLess(fetched, delta.DEFAULT_BLOCK_SIZE)
+
+    def test_short_zero_last_block(self):
+        remote = self.rng.randbytes(2 * 1024 * 1024) + bytes(2 * 1024 * 1024 + 1000)
+        local = self.rng.randbytes(100) + remote[:-1000]
+        index, sources, elapsed = self.match(remote, local)
+        self.assertLess(elapsed, 2)
+        data, fetched = self.rebuild(index, sources, local, remote)
+        self.assertEqual(data, remote)
+        self.assertLessEqual(fetched, delta.DEFAULT_BLOCK_SIZE)
+
+    def test_shifted_blocks(self):
+        remote = self.rng.randbytes(1024 * 1024)
+        local = self.rng.randbytes(1000) + remote
+        index, sources, _ = self.match(remote, local)
+        self.assertEqual(self.rebuild(index, sources, local, remote), (remote, 0))
+
+    def test_stop(self):
+        remote = self.rng.randbytes(1024 * 1024)
+        local = self.rng.randbytes(2 * 1024 * 1024)
+        index, sources, elapsed = self.match(remote, local, stop=lambda: True)
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(sources, [None] * len(index["blocks"]))
+
+
+if __name__ == "__main__":
+    unittest.main()